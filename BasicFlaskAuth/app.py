@@ -1,5 +1,10 @@
-from flask import Flask, request, abort
+from flask import Flask, request, abort, jsonify
+import hashlib
 import json
+import os
+import threading
+import time
+from collections import OrderedDict
 from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
@@ -11,6 +16,15 @@ AUTH0_DOMAIN = @TODO_REPLACE_WITH_YOUR_DOMAIN
 ALGORITHMS = ['RS256']
 API_AUDIENCE = @TODO_REPLACE_WITH_YOUR_API_AUDIENCE
 
+JWKS_URL = os.environ.get(
+    'JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+JWKS_TTL = 600
+JWKS_STALE_GRACE = 3600
+JWKS_RETRY_INTERVAL = 30
+
+REJECTED_TOKEN_TTL = 30
+REJECTED_TOKEN_CACHE_SIZE = 10000
+
 
 class AuthError(Exception):
     def __init__(self, error, status_code):
@@ -18,6 +32,145 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+class KeyNotFoundError(AuthError):
+    """The token's kid is not in the current key set. That is about our
+    keys (the provider may have rotated them), not about the token.
+    """
+
+
+class RejectedTokenCache:
+    """Remembers, for a short while, the digests of tokens that failed
+    verification and why, so a replayed bad token is turned away without
+    another JWKS fetch and RSA verify.
+    """
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token):
+        key = self.digest(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() < entry[0]:
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, token, reason):
+        key = self.digest(token)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, reason)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+rejected_tokens = RejectedTokenCache(REJECTED_TOKEN_TTL,
+                                     REJECTED_TOKEN_CACHE_SIZE)
+
+
+class JWKSStore:
+    """Keeps the provider key set fresh from a daemon thread, renewing it
+    ahead of expiry. Requests read the last-known-good key set and only
+    wait on the provider for the very first fetch. A token with an
+    unknown kid wakes the daemon to pick up rotated keys (at most once
+    per `retry_interval`) instead of fetching on the request thread.
+    When refreshing fails the old keys stay in use for up to `grace`
+    seconds past their ttl.
+    """
+    def __init__(self, url, ttl, grace, retry_interval):
+        self.url = url
+        self.ttl = ttl
+        self.grace = grace
+        self.retry_interval = retry_interval
+        self._jwks = None
+        self._fetched_at = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def refresh(self):
+        with urlopen(self.url, timeout=5) as response:
+            jwks = json.loads(response.read())
+        with self._lock:
+            self._jwks = jwks
+            self._fetched_at = time.monotonic()
+
+    def get(self):
+        if (self._jwks is None or
+                time.monotonic() - self._fetched_at > self.ttl + self.grace):
+            self.refresh()
+        return self._jwks
+
+    def request_refresh(self):
+        """Asks the daemon for a fresh key set after a kid miss, never
+        waits for it
+        """
+        self._wakeup.set()
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        next_refresh = time.monotonic()
+        last_attempt = None
+        while True:
+            woken = self._wakeup.wait(max(next_refresh - time.monotonic(), 0))
+            self._wakeup.clear()
+            if self._stop.is_set():
+                return
+            now = time.monotonic()
+            if (woken and last_attempt is not None and
+                    now - last_attempt < self.retry_interval):
+                # rate limited, refresh as soon as the interval is over
+                next_refresh = min(next_refresh,
+                                   last_attempt + self.retry_interval)
+                continue
+            last_attempt = now
+            try:
+                self.refresh()
+                next_refresh = now + self.ttl * 0.8
+            except Exception:
+                next_refresh = now + self.retry_interval
+
+
+jwks_store = JWKSStore(JWKS_URL, JWKS_TTL, JWKS_STALE_GRACE,
+                       JWKS_RETRY_INTERVAL)
+jwks_store.start()
+
+
 def get_token_auth_header():
     """Obtains the Access Token from the Authorization Header
     """
@@ -51,26 +204,32 @@ def get_token_auth_header():
     return token
 
 
+def find_rsa_key(jwks, kid):
+    for key in jwks['keys']:
+        if key['kid'] == kid:
+            return {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key['use'],
+                'n': key['n'],
+                'e': key['e']
+            }
+    return {}
+
+
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    jwks = jwks_store.get()
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = find_rsa_key(jwks, unverified_header['kid'])
+    if not rsa_key:
+        # the provider may have rotated its keys since the last refresh
+        jwks_store.request_refresh()
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -99,7 +258,7 @@ def verify_decode_jwt(token):
                 'code': 'invalid_header',
                 'description': 'Unable to parse authentication token.'
             }, 400)
-    raise AuthError({
+    raise KeyNotFoundError({
                 'code': 'invalid_header',
                 'description': 'Unable to find the appropriate key.'
             }, 400)
@@ -109,14 +268,31 @@ def requires_auth(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
         token = get_token_auth_header()
+        if rejected_tokens.get(token) is not None:
+            abort(401)
         try:
             payload = verify_decode_jwt(token)
+        except KeyNotFoundError:
+            # not remembered, the token may be signed with a new key
+            abort(401)
+        except AuthError as e:
+            # only verification failures are remembered, a JWKS fetch
+            # error says nothing about the token itself
+            rejected_tokens.put(token, e.error['code'])
+            abort(401)
+        except jwt.JWTError:
+            rejected_tokens.put(token, 'invalid_token')
+            abort(401)
         except:
             abort(401)
         return f(payload, *args, **kwargs)
 
     return wrapper
 
+@app.route('/metrics')
+def metrics():
+    return jsonify({'rejected_tokens': rejected_tokens.stats()})
+
 @app.route('/headers')
 @requires_auth
 def headers(payload):
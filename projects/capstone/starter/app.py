@@ -1,10 +1,32 @@
 import os
-from flask import Flask, request, abort, jsonify
+import base64
+import csv
+import io
+import json
+from datetime import datetime
+from flask import Flask, Response, request, abort, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from models import Actor, Movie, Gender,MovieActor, setup_db
-from auth import AuthError, requires_auth
-
+from sqlalchemy import func, tuple_
+from sqlalchemy.exc import SQLAlchemyError
+from models import Actor, Movie, Gender,MovieActor, setup_db, \
+    bulk_insert, link_movies_actors, table_versions, db
+from auth import AuthError, requires_auth, token_cache, jwks_cache, \
+    shared_token_cache, record_auth_timings, JWKS_BACKGROUND_REFRESH
+import metrics
+import db_pool
+from response_cache import response_cache, conditional
+import fast_json
+from catalog_import import import_catalog
+from fast_json import jsonify
+
+
+BULK_MAX_ITEMS = int(os.environ.get('BULK_MAX_ITEMS', 1000))
+# rows fetched per round trip by the streaming exports
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+# orjson-backed responses with ISO 8601 dates, see fast_json.py
+FAST_JSON = os.environ.get(
+    'FAST_JSON', 'false').lower() in ('1', 'true', 'yes')
 
 
 def create_app(test_config=None):
@@ -12,56 +34,292 @@ def create_app(test_config=None):
     app = Flask(__name__)
     setup_db(app)
     CORS(app)
+    if FAST_JSON:
+        fast_json.init_app(app)
+    app.cli.add_command(import_catalog)
+    if JWKS_BACKGROUND_REFRESH:
+        jwks_cache.start_refresher()
     ELEMENT_By_PAGE = 3
 
-    def paginate_elemets(request, selection):
+    # the list endpoints select these columns as plain rows instead of
+    # hydrating ORM instances, see format_movies / format_actors
+    MOVIE_COLUMNS = (Movie.id, Movie.title, Movie.release_date)
+    ACTOR_COLUMNS = (Actor.id, Actor.name, Actor.age, Actor.gender)
+
+    def paginate_elemets(request, query):
+        """Returns the rows of the requested page and the total count.
+        LIMIT/OFFSET run in the database, so only one page of rows is
+        loaded, and a page past the end is a 404 without fetching any rows.
+        """
         page = request.args.get('page', 1, type=int)
-        start = (page - 1) * ELEMENT_By_PAGE
-        end = start + ELEMENT_By_PAGE
-        if start > len(selection):
+        if page < 1:
             abort(404)
-        if isinstance(selection[0], Movie):
-            elemets = [movie.format() for movie in selection]
+        start = (page - 1) * ELEMENT_By_PAGE
+        model = query.column_descriptions[0]['entity']
+        try:
+            total = query.order_by(None).with_entities(
+                func.count()).select_from(model).scalar()
+            if start >= total:
+                abort(404)
+            selection = query.limit(ELEMENT_By_PAGE).offset(start).all()
+        except SQLAlchemyError:
+            abort(422)
+        return selection, total
+
+    def encode_cursor(values):
+        data = json.dumps(values, separators=(',', ':')).encode()
+        return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+    def decode_cursor(cursor):
+        try:
+            data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            sort_value, last_id = json.loads(data)
+            if not isinstance(last_id, int):
+                raise ValueError(last_id)
+        except (ValueError, TypeError):
+            abort(400)
+        return sort_value, last_id
+
+    def seek_elements(request, query, sort_column):
+        """Keyset pagination: the opaque ?cursor= holds the (sort value, id)
+        of the last element seen, so every page is one index range scan
+        however deep it is. An empty cursor starts at the beginning.
+        The sort columns are nullable: NULLs come last and are paged by id
+        with a second range scan, only run once the values run out.
+        Returns the rows of the page and the cursor of the next one, None
+        on the last page.
+        """
+        cursor = request.args.get('cursor', '')
+        model = sort_column.class_
+        sort_value, last_id = decode_cursor(cursor) if cursor else ('', 0)
+        # one extra row tells whether there is a next page
+        wanted = ELEMENT_By_PAGE + 1
+        try:
+            selection = []
+            if not cursor or sort_value is not None:
+                values = query.filter(sort_column.isnot(None))
+                if cursor:
+                    values = values.filter(
+                        tuple_(sort_column, model.id) > tuple_(sort_value,
+                                                               last_id))
+                selection = values.order_by(sort_column, model.id).limit(
+                    wanted).all()
+                last_id = 0
+            if len(selection) < wanted:
+                nulls = query.filter(sort_column.is_(None))
+                if last_id:
+                    nulls = nulls.filter(model.id > last_id)
+                selection += nulls.order_by(model.id).limit(
+                    wanted - len(selection)).all()
+        except SQLAlchemyError:
+            abort(422)
+        next_cursor = None
+        if len(selection) > ELEMENT_By_PAGE:
+            selection = selection[:ELEMENT_By_PAGE]
+            last = selection[-1]
+            next_cursor = encode_cursor(
+                [getattr(last, sort_column.key), last.id])
+        return selection, next_cursor
+
+    def included_relationship(request, allowed):
+        """Returns ?include=, None when it is absent. The related rows of a
+        whole page are loaded with one IN query by load_included instead
+        of one query per element.
+        """
+        include = request.args.get('include')
+        if include is not None and include != allowed:
+            abort(400)
+        return include
+
+    def load_included(include, ids):
+        """{id: [related rows]} for the movies (include='actors') or the
+        actors (include='movies') in `ids`
+        """
+        if include == 'actors':
+            parent_id, related_id, model = (
+                MovieActor.movie_id, MovieActor.actor_id, Actor)
+            columns = ACTOR_COLUMNS
         else:
-            elemets = [actor.format() for actor in selection]
-        current_elements = elemets[start:end]
-        return current_elements
+            parent_id, related_id, model = (
+                MovieActor.actor_id, MovieActor.movie_id, Movie)
+            columns = MOVIE_COLUMNS
+        related = {}
+        try:
+            rows = db.session.query(parent_id, *columns).select_from(
+                MovieActor).join(model, model.id == related_id).filter(
+                parent_id.in_(ids)).order_by(parent_id, model.id)
+            for row in rows:
+                related.setdefault(row[0], []).append(row[1:])
+        except SQLAlchemyError:
+            abort(422)
+        return related
 
         # This method id added to sort list od categories
 
-    def format_movies(movies):
-        if len(movies) == 0:
+    def format_movies(movies, include=None, allow_empty=False):
+        """Builds the response dicts straight from (id, title,
+        release_date) rows, in one pass
+        """
+        if len(movies) == 0 and not allow_empty:
             abort(404)
+        if include is not None:
+            related = load_included(include, [movie[0] for movie in movies])
         formated_movies = []
-        index = 0
-
-        for index in range(len(movies)):
-            
-            current_movie={
-                'id': movies[index]['id'],
-                'title': movies[index]['title'],
-                'release_date': movies[index]['release_date'],
 
+        for movie_id, title, release_date in movies:
+            current_movie = {
+                'id': movie_id,
+                'title': title,
+                'release_date': release_date,
                 }
+            if include is not None:
+                current_movie[include] = format_actors(
+                    related.get(movie_id, ()), allow_empty=True)
             formated_movies.append(current_movie)
         return formated_movies
 
-    def format_actors(actors):
-        if len(actors) == 0:
+    def format_actors(actors, include=None, allow_empty=False):
+        """Builds the response dicts straight from (id, name, age, gender)
+        rows, in one pass
+        """
+        if len(actors) == 0 and not allow_empty:
             abort(404)
+        if include is not None:
+            related = load_included(include, [actor[0] for actor in actors])
         formated_actors = []
-        index = 0
-
-        for index in range(len(actors)):
-            current_actor={
-                'id': actors[index]['id'],
-                'name': actors[index]['name'],
-                'age': actors[index]['age'],
-                'gender': actors[index]['gender'],
+
+        for actor_id, name, age, gender in actors:
+            current_actor = {
+                'id': actor_id,
+                'name': name,
+                'age': age,
+                'gender': gender.value if gender is not None else None,
                 }
+            if include is not None:
+                current_actor[include] = format_movies(
+                    related.get(actor_id, ()), allow_empty=True)
             formated_actors.append(current_actor)
         return formated_actors
    
+    def csv_value(value):
+        if isinstance(value, datetime):
+            return value.isoformat()
+        if isinstance(value, Gender):
+            return value.value
+        return value
+
+    def export_rows(name, columns):
+        """Streams every row of `columns` as NDJSON, or CSV with
+        ?format=csv. Rows are read through a server-side cursor
+        EXPORT_BATCH_SIZE at a time and each batch is sent as soon as it
+        is fetched, so memory stays flat whatever the table size.
+        """
+        export_format = request.args.get('format', 'ndjson')
+        if export_format not in ('ndjson', 'csv'):
+            abort(400)
+        fields = [column.key for column in columns]
+        query = db.session.query(*columns).order_by(
+            columns[0]).execution_options(stream_results=True).yield_per(
+            EXPORT_BATCH_SIZE)
+
+        def generate_ndjson():
+            batch = []
+            for row in query:
+                batch.append(fast_json.dumps(dict(zip(fields, row))))
+                if len(batch) == EXPORT_BATCH_SIZE:
+                    yield b'\n'.join(batch) + b'\n'
+                    batch = []
+            if batch:
+                yield b'\n'.join(batch) + b'\n'
+
+        def generate_csv():
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(fields)
+            # the header goes out before the query runs
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+            rows = 0
+            for row in query:
+                writer.writerow([csv_value(value) for value in row])
+                rows += 1
+                if rows % EXPORT_BATCH_SIZE == 0:
+                    yield buffer.getvalue().encode()
+                    buffer.seek(0)
+                    buffer.truncate()
+            if buffer.tell():
+                yield buffer.getvalue().encode()
+
+        if export_format == 'csv':
+            generate, mimetype = generate_csv, 'text/csv'
+        else:
+            generate, mimetype = generate_ndjson, 'application/x-ndjson'
+        return Response(
+            stream_with_context(generate()), mimetype=mimetype,
+            headers={'Content-Disposition':
+                     'attachment; filename={}.{}'.format(name, export_format)})
+
+    def validate_movie(item):
+        """Returns the column values of a bulk movie item and the errors
+        found, by field
+        """
+        errors = {}
+        title = item.get('title')
+        if not isinstance(title, str) or not title.strip():
+            errors['title'] = 'required'
+        release_date = item.get('release_date')
+        try:
+            release_date = datetime.fromisoformat(release_date)
+        except (TypeError, ValueError):
+            errors['release_date'] = 'expected an ISO date'
+        return {'title': title, 'release_date': release_date}, errors
+
+    def validate_actor(item):
+        errors = {}
+        name = item.get('name')
+        if not isinstance(name, str) or not name.strip():
+            errors['name'] = 'required'
+        age = item.get('age')
+        if not isinstance(age, int) or isinstance(age, bool) or age < 0:
+            errors['age'] = 'expected a non-negative integer'
+        gender = item.get('gender')
+        try:
+            gender = Gender[gender.upper()]
+        except (AttributeError, KeyError):
+            errors['gender'] = 'expected one of ' + ', '.join(
+                member.name.lower() for member in Gender)
+        return {'name': name, 'age': age, 'gender': gender}, errors
+
+    def validate_bulk(data, validate_item):
+        """Validates every item of a bulk request body. The whole batch is
+        rejected with the errors of each invalid item, by index, so a
+        client can fix them all in one go.
+        """
+        if not isinstance(data, list) or not data:
+            abort(422)
+        if len(data) > BULK_MAX_ITEMS:
+            abort(413)
+        rows = []
+        errors = []
+        for index, item in enumerate(data):
+            if not isinstance(item, dict):
+                errors.append({'index': index,
+                               'errors': {'item': 'expected an object'}})
+                continue
+            row, item_errors = validate_item(item)
+            if item_errors:
+                errors.append({'index': index, 'errors': item_errors})
+            rows.append(row)
+        if errors:
+            return rows, (jsonify({
+                'success': False,
+                'error': 422,
+                'message': 'invalid items',
+                'errors': errors,
+                }), 422)
+        return rows, None
+
     @app.after_request
     def after_request(response):
         response.headers.add(
@@ -72,29 +330,47 @@ def create_app(test_config=None):
             'Access-Control-Allow-Methods',
             'GET, POST, PATCH, DELETE, OPTIONS'
             )
-        return(response)
+        return(record_auth_timings(response))
 
 
     @app.route('/movies', methods=['GET'])
     @requires_auth('get:movies')
+    @conditional(table_versions, 'movies',
+                 included=('movies_actors', 'actors'))
+    @response_cache.cached('movies', included=('movies_actors', 'actors'))
     def get_movies(payload):
-        try:
-            movies = Movie.query.order_by(Movie.title).all()
-            if len(movies) == 0:
-                abort(404)
-        except:
-            abort(422)
-        
-        current_movies = paginate_elemets(request, movies)
+        include = included_relationship(request, 'actors')
+        query = db.session.query(*MOVIE_COLUMNS)
+        if 'cursor' in request.args:
+            current_movies, next_cursor = seek_elements(
+                request, query, Movie.title)
+            return(jsonify({
+                'success': True,
+                'movies': format_movies(current_movies, include),
+                'next_cursor': next_cursor,
+                'status_code': 200
+                })), 200
+
+        current_movies, total_movies = paginate_elemets(
+            request, query.order_by(Movie.title, Movie.id))
         return(jsonify({
             'success': True,
-            'movies': format_movies(current_movies),
+            'movies': format_movies(current_movies, include),
+            'total_movies': total_movies,
             'status_code': 200
             })), 200
 
 
+    @app.route('/movies/export', methods=['GET'])
+    @requires_auth('get:movies')
+    def export_movies(payload):
+        return export_rows('movies', MOVIE_COLUMNS)
+
+
     @app.route('/movies/<int:movie_id>', methods=['GET'])
     @requires_auth('get:movies')
+    @conditional(table_versions, 'movies')
+    @response_cache.cached('movies')
     def get_movie(payload, movie_id):
         try:
             movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
@@ -130,6 +406,24 @@ def create_app(test_config=None):
             abort(422)
 
 
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('post:movies')
+    def add_movies(payload):
+        rows, invalid = validate_bulk(
+            request.get_json(silent=True), validate_movie)
+        if invalid:
+            return invalid
+        try:
+            movie_ids = bulk_insert(Movie, rows)
+        except SQLAlchemyError:
+            abort(422)
+        return jsonify({
+            'success': True,
+            'status_code': 201,
+            'movie_ids': movie_ids,
+        }), 201
+
+
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
     @requires_auth('patch:movies')
     def update_movie(payload, movie_id):
@@ -169,23 +463,41 @@ def create_app(test_config=None):
 
     @app.route('/actors', methods=['GET'])
     @requires_auth('get:actors')
+    @conditional(table_versions, 'actors',
+                 included=('movies_actors', 'movies'))
+    @response_cache.cached('actors', included=('movies_actors', 'movies'))
     def get_actors(payload):
-        try:
-            actors = Actor.query.order_by(Actor.name).all()
-            if len(actors) == 0:
-                abort(404)
-        except:
-            abort(422)
-        
-        current_actors = paginate_elemets(request, actors)
+        include = included_relationship(request, 'movies')
+        query = db.session.query(*ACTOR_COLUMNS)
+        if 'cursor' in request.args:
+            current_actors, next_cursor = seek_elements(
+                request, query, Actor.name)
+            return(jsonify({
+                'success': True,
+                'actors': format_actors(current_actors, include),
+                'next_cursor': next_cursor,
+                'status_code': 200
+                })), 200
+
+        current_actors, total_actors = paginate_elemets(
+            request, query.order_by(Actor.name, Actor.id))
         return(jsonify({
             'success': True,
-            'actors': format_actors(current_actors),
+            'actors': format_actors(current_actors, include),
+            'total_actors': total_actors,
             'status_code': 200
             })), 200
 
+    @app.route('/actors/export', methods=['GET'])
+    @requires_auth('get:actors')
+    def export_actors(payload):
+        return export_rows('actors', ACTOR_COLUMNS)
+
+
     @app.route('/actors/<int:actor_id>', methods=['GET'])
     @requires_auth('get:actors')
+    @conditional(table_versions, 'actors')
+    @response_cache.cached('actors')
     def get_actor(payload, actor_id):
         try:
             actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
@@ -222,6 +534,24 @@ def create_app(test_config=None):
             abort(422)
 
 
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('post:actors')
+    def add_actors(payload):
+        rows, invalid = validate_bulk(
+            request.get_json(silent=True), validate_actor)
+        if invalid:
+            return invalid
+        try:
+            actor_ids = bulk_insert(Actor, rows)
+        except SQLAlchemyError:
+            abort(422)
+        return jsonify({
+            'success': True,
+            'status_code': 201,
+            'actor_ids': actor_ids,
+        }), 201
+
+
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
     @requires_auth('patch:actors')
     def update_actor(payload, actor_id):
@@ -263,8 +593,7 @@ def create_app(test_config=None):
 
 
     @app.route('/movie_actor', methods=['POST'])
-    @requires_auth('patch:actors')
-    @requires_auth('patch:movies')
+    @requires_auth('patch:actors', 'patch:movies')
     def connect_movie_actor(payload):
         data = request.get_json()
         movie_id = data.get('movie_id', None)
@@ -294,9 +623,78 @@ def create_app(test_config=None):
             abort(422)
 
 
+    @app.route('/movie_actor/bulk', methods=['POST'])
+    @requires_auth('patch:actors', 'patch:movies')
+    def connect_movies_actors(payload):
+        """Links many (movie_id, actor_id) pairs at once. Every id is checked
+        with one IN query per table and links that already exist are
+        skipped, so the call can safely be repeated.
+        """
+        data = request.get_json(silent=True)
+        if not isinstance(data, list) or not data:
+            abort(422)
+        if len(data) > BULK_MAX_ITEMS:
+            abort(413)
+        links = []
+        for item in data:
+            try:
+                movie_id, actor_id = item['movie_id'], item['actor_id']
+            except (TypeError, KeyError):
+                movie_id = actor_id = None
+            links.append((movie_id, actor_id))
+
+        movie_ids = {movie_id for movie_id, _ in links
+                     if isinstance(movie_id, int)}
+        actor_ids = {actor_id for _, actor_id in links
+                     if isinstance(actor_id, int)}
+        try:
+            found_movies = {movie_id for movie_id, in db.session.query(
+                Movie.id).filter(Movie.id.in_(movie_ids))}
+            found_actors = {actor_id for actor_id, in db.session.query(
+                Actor.id).filter(Actor.id.in_(actor_ids))}
+        except SQLAlchemyError:
+            abort(422)
+
+        errors = []
+        for index, (movie_id, actor_id) in enumerate(links):
+            item_errors = {}
+            if movie_id not in found_movies:
+                item_errors['movie_id'] = 'no such movie'
+            if actor_id not in found_actors:
+                item_errors['actor_id'] = 'no such actor'
+            if item_errors:
+                errors.append({'index': index, 'errors': item_errors})
+        if errors:
+            return jsonify({
+                'success': False,
+                'error': 422,
+                'message': 'invalid items',
+                'errors': errors,
+                }), 422
+
+        try:
+            linked = link_movies_actors(links)
+        except SQLAlchemyError:
+            abort(422)
+        return jsonify({
+            'success': True,
+            'status_code': 201,
+            'linked': linked,
+            'skipped': len(links) - linked,
+        }), 201
+
+
+    @app.route('/movie_actor/export', methods=['GET'])
+    @requires_auth('get:movies', 'get:actors')
+    def export_movies_actors(payload):
+        return export_rows('movies_actors', (
+            MovieActor.id, MovieActor.movie_id, MovieActor.actor_id))
+
+
     @app.route('/movies/<int:movie_id>/actors', methods=['GET'])
-    @requires_auth('get:movies')
-    @requires_auth('get:actors')
+    @requires_auth('get:movies', 'get:actors')
+    @conditional(table_versions, 'movies', 'movies_actors', 'actors')
+    @response_cache.cached('movies', 'movies_actors', 'actors')
     def get_movie_actors(payload, movie_id):
         try:
             actors = Movie.query.filter(Movie.id == movie_id).one_or_none().actors
@@ -309,6 +707,27 @@ def create_app(test_config=None):
             abort(404)
 
 
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        return jsonify({
+            'success': True,
+            'auth': {
+                'token_cache': token_cache.stats(),
+                'shared_token_cache': (shared_token_cache.stats()
+                                       if shared_token_cache else None),
+                'jwks': {
+                    'fetches': jwks_cache.fetch_count,
+                    'failures': jwks_cache.failure_count,
+                    'stale': jwks_cache.expired(),
+                },
+                'timings': metrics.snapshot('auth'),
+            },
+            'response_cache': response_cache.stats(),
+            'db_pool': db_pool.stats(db.engine),
+            'status_code': 200
+            }), 200
+
+
     @app.errorhandler(404)
     def not_found(error):
         return jsonify({
@@ -325,6 +744,15 @@ def create_app(test_config=None):
             'message': 'bad request'
         }), 400
 
+    @app.errorhandler(413)
+    def too_large(error):
+        return jsonify({
+            'success': False,
+            'error': 413,
+            'message': 'too many items, the limit is {}'.format(
+                BULK_MAX_ITEMS)
+        }), 413
+
     @app.errorhandler(422)
     def method_not_allowed(error):
         return jsonify({
@@ -336,7 +764,25 @@ def create_app(test_config=None):
 
     return app
 
-APP = create_app()
+_app = None
+
+
+def get_app():
+    """The module's app, created on first use rather than at import
+    """
+    global _app
+    if _app is None:
+        _app = create_app()
+    return _app
+
+
+def __getattr__(name):
+    # `app:APP` (gunicorn, flask) still works, the app is only built when
+    # it is first looked up
+    if name == 'APP':
+        return get_app()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
 
 if __name__ == '__main__':
-    APP.run(host='0.0.0.0', port=8080, debug=True)
\ No newline at end of file
+    get_app().run(host='0.0.0.0', port=8080, debug=True)
\ No newline at end of file
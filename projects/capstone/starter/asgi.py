@@ -0,0 +1,428 @@
+'''
+ASGI entry point for the catalog routes, served by async handlers:
+
+    uvicorn asgi:application --workers 4
+
+Routes: GET /movies, GET /actors (?page=, same pages as the Flask app),
+GET /movies/<id>/actors and POST /movie_actor, with the same auth, CORS
+headers and responses as app.py. ?cursor= and ?include= are a 400 here,
+they and everything else stay on the WSGI app.
+
+The database is reached through SQLAlchemy's async engine when it is
+available (SQLAlchemy >= 1.4 with asyncpg, or aiosqlite for SQLite).
+With the pinned SQLAlchemy 1.3 there is no async engine; the statements
+then run on a regular engine in a thread pool no larger than the
+connection pool, so the event loop is never blocked either way.
+Token verification never runs on the event loop: only the in-process
+token cache is read there. On a miss, the shared token cache, the JWKS
+and the RS256 check run in a worker thread. The background refresher is
+started with the app.
+'''
+import asyncio
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import parse_qs
+
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import http_date
+
+import auth
+import db_pool
+import fast_json
+from models import Actor, Movie, MovieActor, TableVersion, database_path
+
+try:
+    from sqlalchemy.ext.asyncio import create_async_engine
+except ImportError:  # SQLAlchemy < 1.4
+    create_async_engine = None
+
+
+# same page size as ELEMENT_By_PAGE in app.py
+ELEMENT_By_PAGE = 3
+FAST_JSON = os.environ.get(
+    'FAST_JSON', 'false').lower() in ('1', 'true', 'yes')
+ASYNC_DRIVERS = {
+    'postgres': 'postgresql+asyncpg',
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+movies = Movie.__table__
+actors = Actor.__table__
+movies_actors = MovieActor.__table__
+table_versions = TableVersion.__table__
+
+
+class HTTPError(Exception):
+    def __init__(self, status_code, message):
+        self.status_code = status_code
+        self.message = message
+
+
+'''
+Database
+    runs Core statements on the async engine, or on a sync engine in a
+    bounded thread pool when there is no async engine to use
+'''
+class Database:
+    def __init__(self, url):
+        self.url = url
+        self.async_engine = None
+        self.engine = None
+        self.executor = None
+        scheme, _, rest = url.partition('://')
+        driver = ASYNC_DRIVERS.get(scheme.split('+')[0])
+        if create_async_engine is not None and driver is not None:
+            try:
+                self.async_engine = create_async_engine(
+                    '{}://{}'.format(driver, rest),
+                    **_async_options(db_pool.engine_options(url)))
+            except ImportError:
+                # the async driver isn't installed
+                self.async_engine = None
+        if self.async_engine is None:
+            options = db_pool.engine_options(url)
+            self.engine = create_engine(url, **options)
+            threads = (options.get('pool_size', 5)
+                       + max(options.get('max_overflow', 10), 0))
+            self.executor = ThreadPoolExecutor(
+                max_workers=threads, thread_name_prefix='asgi-db')
+
+    @property
+    def mode(self):
+        return 'async' if self.async_engine is not None else 'threadpool'
+
+    async def _run(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, function, *args)
+
+    def _fetch_all_sync(self, statement):
+        with self.engine.connect() as connection:
+            return connection.execute(statement).fetchall()
+
+    def _transaction_sync(self, statements):
+        with self.engine.begin() as connection:
+            for statement in statements:
+                connection.execute(statement)
+
+    async def fetch_all(self, statement):
+        if self.async_engine is None:
+            return await self._run(self._fetch_all_sync, statement)
+        async with self.async_engine.connect() as connection:
+            result = await connection.execute(statement)
+            return result.fetchall()
+
+    async def fetch_one(self, statement):
+        rows = await self.fetch_all(statement)
+        return rows[0] if rows else None
+
+    async def transaction(self, *statements):
+        """Runs `statements` in one transaction
+        """
+        if self.async_engine is None:
+            return await self._run(self._transaction_sync, statements)
+        async with self.async_engine.begin() as connection:
+            for statement in statements:
+                await connection.execute(statement)
+
+    async def dispose(self):
+        if self.async_engine is not None:
+            await self.async_engine.dispose()
+        else:
+            self.engine.dispose()
+            self.executor.shutdown(wait=False)
+
+
+def _async_options(options):
+    # async engines pick their own pool class
+    options = dict(options)
+    options.pop('poolclass', None)
+    return options
+
+
+def _default(obj):
+    # the WSGI app's default encoding, dates as HTTP dates
+    if isinstance(obj, datetime):
+        return http_date(obj)
+    raise TypeError(f'{type(obj).__name__} is not JSON serializable')
+
+
+def dumps(data):
+    if FAST_JSON:
+        return fast_json.dumps(data)
+    return json.dumps(data, default=_default).encode()
+
+
+async def authenticate(headers, *permissions):
+    """Verifies the bearer token and the route's permissions, returns the
+    payload
+    """
+    header = headers.get(b'authorization', b'').decode('latin-1')
+    parts = header.split()
+    if len(parts) != 2 or parts[0].lower() != 'bearer':
+        raise HTTPError(401, 'unauthorized')
+    token = parts[1]
+    try:
+        # only the in-process cache is read on the event loop, the shared
+        # cache, JWKS and RS256 verification run in a worker thread
+        entry = auth.token_cache.lookup(token)
+        if entry is None:
+            loop = asyncio.get_running_loop()
+            entry = await loop.run_in_executor(
+                None, auth.verify_uncached_token, token)
+        payload, granted = entry
+        auth.check_compiled_permissions(frozenset(permissions), granted)
+    except HTTPException as e:
+        raise HTTPError(e.code, e.name.lower())
+    except auth.AuthError as e:
+        raise HTTPError(e.status_code, e.error['description'])
+    return payload
+
+
+async def list_page(db, query_string, table, columns, order_by, key,
+                    format_row):
+    if 'cursor' in query_string or 'include' in query_string:
+        # keyset pages and included relationships are only served by
+        # the WSGI app, a silent offset page would mislead the client
+        raise HTTPError(400, 'bad request')
+    try:
+        page = int(query_string.get('page', ['1'])[0])
+    except ValueError:
+        page = 1
+    if page < 1:
+        raise HTTPError(404, 'resource not found')
+    start = (page - 1) * ELEMENT_By_PAGE
+    try:
+        total = (await db.fetch_one(
+            select([func.count()]).select_from(table)))[0]
+        if start >= total:
+            raise HTTPError(404, 'resource not found')
+        rows = await db.fetch_all(
+            select(columns).order_by(*order_by).limit(
+                ELEMENT_By_PAGE).offset(start))
+    except SQLAlchemyError:
+        raise HTTPError(422, 'Unprocessable Entity')
+    return 200, {
+        'success': True,
+        key: [format_row(row) for row in rows],
+        'total_' + key: total,
+        'status_code': 200,
+    }
+
+
+def format_movie(row):
+    movie_id, title, release_date = row
+    return {'id': movie_id, 'title': title, 'release_date': release_date}
+
+
+def format_actor(row):
+    actor_id, name, age, gender = row
+    return {'id': actor_id, 'name': name, 'age': age,
+            'gender': gender.value if gender is not None else None}
+
+
+async def get_movies(db, request):
+    await authenticate(request['headers'], 'get:movies')
+    return await list_page(
+        db, request['query'], movies,
+        [movies.c.id, movies.c.title, movies.c.release_date],
+        (movies.c.title, movies.c.id), 'movies', format_movie)
+
+
+async def get_actors(db, request):
+    await authenticate(request['headers'], 'get:actors')
+    return await list_page(
+        db, request['query'], actors,
+        [actors.c.id, actors.c.name, actors.c.age, actors.c.gender],
+        (actors.c.name, actors.c.id), 'actors', format_actor)
+
+
+async def get_movie_actors(db, request, movie_id):
+    await authenticate(request['headers'], 'get:movies', 'get:actors')
+    movie = await db.fetch_one(
+        select([movies.c.id]).where(movies.c.id == movie_id))
+    if movie is None:
+        raise HTTPError(404, 'resource not found')
+    rows = await db.fetch_all(
+        select([actors.c.name, actors.c.age, actors.c.gender]).select_from(
+            movies_actors.join(actors,
+                               actors.c.id == movies_actors.c.actor_id))
+        .where(movies_actors.c.movie_id == movie_id)
+        .order_by(movies_actors.c.id))
+    return 200, {
+        'status_code': 200,
+        'success': True,
+        'actors': [{'name': name, 'age': age, 'gender': gender.value}
+                   for name, age, gender in rows],
+    }
+
+
+async def connect_movie_actor(db, request):
+    await authenticate(request['headers'], 'patch:actors', 'patch:movies')
+    try:
+        data = json.loads(request['body'] or b'null')
+        movie_id, actor_id = data.get('movie_id'), data.get('actor_id')
+    except (ValueError, AttributeError):
+        raise HTTPError(422, 'Unprocessable Entity')
+    if not movie_id or not actor_id:
+        raise HTTPError(422, 'Unprocessable Entity')
+    movie, actor = await asyncio.gather(
+        db.fetch_one(select([movies.c.id]).where(movies.c.id == movie_id)),
+        db.fetch_one(select([actors.c.id]).where(actors.c.id == actor_id)))
+    if movie is None or actor is None:
+        raise HTTPError(422, 'Unprocessable Entity')
+    try:
+        # the table version moves in the same transaction, see models.touch
+        await db.transaction(
+            movies_actors.insert().values(
+                movie_id=movie_id, actor_id=actor_id),
+            table_versions.update()
+            .where(table_versions.c.name == movies_actors.name)
+            .values(version=table_versions.c.version + 1))
+    except SQLAlchemyError:
+        raise HTTPError(422, 'Unprocessable Entity')
+    return 201, {'success': True, 'status_code': 201}
+
+
+ROUTES = [
+    ('GET', re.compile(r'/movies$'), get_movies),
+    ('GET', re.compile(r'/actors$'), get_actors),
+    ('GET', re.compile(r'/movies/(\d+)/actors$'), get_movie_actors),
+    ('POST', re.compile(r'/movie_actor$'), connect_movie_actor),
+]
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+def cors_headers(request_headers):
+    """The headers CORS(app) and the after_request hook add in app.py
+    """
+    origin = request_headers.get(b'origin')
+    headers = [
+        (b'access-control-allow-origin', origin or b'*'),
+        (b'access-control-allow-headers', b'Content-Type, Authorization'),
+        (b'access-control-allow-methods',
+         b'GET, POST, PATCH, DELETE, OPTIONS'),
+    ]
+    if origin:
+        headers.append((b'vary', b'Origin'))
+    return headers
+
+
+async def send_json(send, status, data, headers=()):
+    body = dumps(data)
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+            *headers,
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_preflight(send, methods, headers):
+    allow = ', '.join(sorted(methods | {'OPTIONS'})).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'allow', allow), (b'content-length', b'0'), *headers],
+    })
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+'''
+CatalogApplication
+    the ASGI callable; `application` below is the instance to serve
+'''
+class CatalogApplication:
+    def __init__(self, url=None):
+        self.url = url or database_path
+        self.db = None
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def startup(self):
+        if self.db is None:
+            self.db = Database(self.url)
+        if auth.JWKS_BACKGROUND_REFRESH:
+            auth.jwks_cache.start_refresher()
+
+    async def shutdown(self):
+        if auth.jwks_cache.refreshing:
+            # joins the refresher thread, which may be mid-fetch
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, auth.jwks_cache.stop_refresher)
+        if self.db is not None:
+            await self.db.dispose()
+            self.db = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        if self.db is None:
+            # servers without lifespan support
+            self.startup()
+
+        path = scope['path']
+        request_headers = dict(scope['headers'])
+        headers = cors_headers(request_headers)
+        handler, methods = None, set()
+        for method, pattern, view in ROUTES:
+            match = pattern.match(path)
+            if match:
+                methods.add(method)
+                if method == scope['method']:
+                    handler, args = view, [int(arg) for arg in match.groups()]
+                    break
+        if handler is None:
+            if methods and scope['method'] == 'OPTIONS':
+                return await send_preflight(send, methods, headers)
+            status, message = ((405, 'method not allowed') if methods
+                               else (404, 'resource not found'))
+            return await send_json(send, status, {
+                'success': False, 'error': status, 'message': message},
+                headers)
+
+        request = {
+            'headers': request_headers,
+            'query': parse_qs(scope.get('query_string', b'').decode(),
+                              keep_blank_values=True),
+            'body': await read_body(receive) if scope['method'] == 'POST'
+            else b'',
+        }
+        try:
+            status, data = await handler(self.db, request, *args)
+        except HTTPError as e:
+            status, data = e.status_code, {
+                'success': False, 'error': e.status_code,
+                'message': e.message}
+        await send_json(send, status, data, headers)
+
+
+application = CatalogApplication()
@@ -1,14 +1,56 @@
-import json
+import os
+import time
+from contextlib import contextmanager
 from flask import request, _request_ctx_stack, abort
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
+import metrics
+from jwks import JWKSCache
+from token_cache import TokenCache, SharedTokenCache, compile_permissions
 
 
-AUTH0_DOMAIN = 'd5-tariq.us.auth0.com'
+AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN', 'd5-tariq.us.auth0.com')
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'capstone'
 
+# The signing keys are fetched once per process and cached, see jwks.py.
+# JWKS_URL may point at a local file or a local JWKS server for tests;
+# a localhost AUTH0_DOMAIN (the local_auth.py stand-in) is plain http.
+JWKS_SCHEME = ('http' if AUTH0_DOMAIN.split(':')[0] in ('localhost', '127.0.0.1')
+               else 'https')
+JWKS_URL = os.environ.get(
+    'JWKS_URL', f'{JWKS_SCHEME}://{AUTH0_DOMAIN}/.well-known/jwks.json')
+JWKS_CACHE_TTL = int(os.environ.get('JWKS_CACHE_TTL', 600))
+JWKS_MIN_REFRESH_INTERVAL = int(os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+# how long the last-known-good keys are served when refreshing fails
+JWKS_STALE_GRACE = int(os.environ.get('JWKS_STALE_GRACE', 3600))
+JWKS_BACKGROUND_REFRESH = os.environ.get(
+    'JWKS_BACKGROUND_REFRESH', 'true').lower() in ('1', 'true', 'yes')
+
+jwks_cache = JWKSCache(
+    JWKS_URL,
+    ttl=JWKS_CACHE_TTL,
+    min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+    grace=JWKS_STALE_GRACE
+)
+
+# Verified payloads are cached by token digest until the token expires,
+# so a reused bearer token only pays for RS256 verification once.
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+
+token_cache = TokenCache(maxsize=TOKEN_CACHE_SIZE)
+
+# Optional second level shared by all workers on the host, in a directory
+# only the app user can access, e.g.
+# TOKEN_SHARED_CACHE_PATH=/run/capstone/tokens.sqlite (mode 0700)
+TOKEN_SHARED_CACHE_PATH = os.environ.get('TOKEN_SHARED_CACHE_PATH')
+TOKEN_SHARED_CACHE_SIZE = int(os.environ.get('TOKEN_SHARED_CACHE_SIZE', 100000))
+
+shared_token_cache = None
+if TOKEN_SHARED_CACHE_PATH:
+    shared_token_cache = SharedTokenCache(
+        TOKEN_SHARED_CACHE_PATH, maxsize=TOKEN_SHARED_CACHE_SIZE)
+
 ## AuthError Exception
 '''
 AuthError Exception
@@ -89,52 +131,98 @@ def get_token_auth_header():
 
 
 
-def check_permissions(permission, payload):
-    if 'permissions' not in payload:
-        abort(400)
-
-    if permission not in payload['permissions']:
-        abort(401)
-        raise AuthError({
-            'code': 'unauthorized',
-            'description': 'Permission Not found',
-        }, 401)
-    return True
+# Auth stage timings
 
+@contextmanager
+def auth_stage(stage):
+    """Adds the time spent in the block to the current request's
+    timing for `stage`, failed stages included
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        ctx = _request_ctx_stack.top
+        if ctx is not None:
+            timings = getattr(ctx, 'auth_timings', None)
+            if timings is None:
+                timings = ctx.auth_timings = {}
+            timings[stage] = (timings.get(stage, 0.0)
+                              + time.perf_counter() - started)
+
+
+def record_auth_timings(response):
+    """Files the auth stage timings of the current request into the
+    per-route histograms and reports them in a Server-Timing header
+    """
+    timings = getattr(_request_ctx_stack.top, 'auth_timings', None)
+    if not timings:
+        return response
+    route = request.endpoint or 'unknown'
+    timings = dict(timings, total=sum(timings.values()))
+    server_timing = []
+    for stage, seconds in timings.items():
+        milliseconds = seconds * 1000
+        metrics.histogram('auth', route, stage).observe(milliseconds)
+        server_timing.append(f'auth-{stage};dur={milliseconds:.3f}')
+    response.headers.add('Server-Timing', ', '.join(server_timing))
+    return response
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-    unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
-    if 'kid' not in unverified_header:
-        abort(401)
-        raise AuthError({
-            'code': 'invalid_header',
-            'description': 'Authorization malformed.'
-        }, 401)
+    payload, permissions = verify_token(token)
+    return payload
+
+
+def verify_token(token):
+    """Verifies `token` and returns its payload together with its
+    permissions compiled into a frozenset (None without a permissions
+    claim). Both come from the token cache when the token was seen before.
+    """
+    with auth_stage('cache'):
+        entry = token_cache.lookup(token)
+    if entry is not None:
+        return entry
+    return verify_uncached_token(token)
+
+
+def verify_uncached_token(token):
+    """verify_token after an in-process cache miss: the shared cache
+    (a SQLite read) or the full RS256 verification, either may block
+    """
+    if shared_token_cache is not None:
+        with auth_stage('cache'):
+            payload = shared_token_cache.get(token)
+        if payload is not None:
+            entry = payload, compile_permissions(payload)
+            token_cache.put(token, *entry)
+            return entry
+
+    with auth_stage('jwks'):
+        unverified_header = jwt.get_unverified_header(token)
+        if 'kid' not in unverified_header:
+            abort(401)
+            raise AuthError({
+                'code': 'invalid_header',
+                'description': 'Authorization malformed.'
+            }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
-    if rsa_key:
+        public_key = jwks_cache.get_key(unverified_header['kid'])
+    if public_key:
         try:
-            payload = jwt.decode(
-                token,
-                rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
-            )
-
-            return payload
+            with auth_stage('decode'):
+                payload = jwt.decode(
+                    token,
+                    public_key,
+                    algorithms=ALGORITHMS,
+                    audience=API_AUDIENCE,
+                    issuer='https://' + AUTH0_DOMAIN + '/'
+                )
+            permissions = compile_permissions(payload)
+            token_cache.put(token, payload, permissions)
+            if shared_token_cache is not None:
+                shared_token_cache.put(token, payload)
+            return payload, permissions
 
         except jwt.ExpiredSignatureError:
             abort(401)
@@ -158,83 +246,67 @@ def verify_decode_jwt(token):
                 'code': 'invalid_header',
                 'description': 'Unable to find the appropriate key.'
             }, 400)
-    # Get public key from Auth0
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
 
-    # Get the data in the header
-    unverified_header = jwt.get_unverified_header(token)
 
-    # Auth0 token should have a key id
-    if 'kid' not in unverified_header:
+def _get_verified_token():
+    # decoded once per request, kept on the request context for every
+    # later auth check of the same request
+    ctx = _request_ctx_stack.top
+    payload = getattr(ctx, 'current_user', None)
+    if payload is None:
+        with auth_stage('header'):
+            token = get_token_auth_header()
+        payload, permissions = verify_token(token)
+        ctx.current_user = payload
+        ctx.current_permissions = permissions
+    return payload, ctx.current_permissions
+
+
+def check_compiled_permissions(required, granted, any_of=False):
+    """`required` and `granted` are frozensets, see compile_permissions
+    """
+    if not required:
+        return True
+    if granted is None:
+        abort(400)
+
+    if any_of:
+        allowed = not required.isdisjoint(granted)
+    else:
+        allowed = required <= granted
+    if not allowed:
         abort(401)
         raise AuthError({
-            'code': 'invalid_header',
-            'description': 'Authorization malformed'
+            'code': 'unauthorized',
+            'description': 'Permission Not found',
         }, 401)
+    return True
 
-    rsa_key = {}
-
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
-            break
-
-    # verify the token
-    if rsa_key:
-        try:
-            # Validate the token using the rsa_key
-            payload = jwt.decode(
-                token,
-                rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer=f'https://{AUTH0_DOMAIN}/'
-            )
-            return payload
-
-        except jwt.ExpiredSignatureError:
-            abort(401)
-            raise AuthError({
-                'code': 'token_expired',
-                'description': 'Token expired.'
-            }, 401)
-
-        except jwt.JWTClaimsError:
-            abort(401)
-            raise AuthError({
-                'code': 'invalid_claims',
-                'description': 'Incorrect claims. Please, '
-                'check the audience and issuer.'
-            }, 401)
-
-        except Exception:
-
-            raise AuthError({
-                'code': 'invalid_header',
-                'description': 'Unable to parse authentication token.'
-            }, 400)
-
-    raise AuthError({
-        'code': 'invalid_header',
-        'description': 'Unable to find the appropriate key.'
-    }, 400)
 
+'''
+requires_auth(*permissions, any_of=False)
+    the token must carry every listed permission, or at least one of
+    them with any_of=True. Stacked requires_auth decorators share one
+    decode and the route still receives the payload once.
+    The required permissions are compiled into a frozenset here, the
+    token's own are compiled once when it's verified, so the check is a
+    set test however many scopes the token carries.
+'''
+def requires_auth(*permissions, any_of=False):
+    required = frozenset(permissions)
 
-def requires_auth(permission=''):
     def requires_auth_decorator(f):
+        nested = getattr(f, 'requires_auth', False)
+
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            payload, granted = _get_verified_token()
+            with auth_stage('permissions'):
+                check_compiled_permissions(required, granted, any_of)
+            if nested:
+                return f(*args, **kwargs)
             return f(payload, *args, **kwargs)
 
+        wrapper.requires_auth = True
         return wrapper
     return requires_auth_decorator
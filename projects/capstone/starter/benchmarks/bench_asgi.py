@@ -0,0 +1,203 @@
+'''
+WSGI vs ASGI under load: requests/s and p99 latency of the catalog routes.
+
+    python benchmarks/bench_asgi.py [connections] [seconds] [rows]
+
+Seeds `rows` (default 1000) movies and actors into BENCH_DATABASE_URL
+(default a SQLite file in the temp directory; point it at a local
+PostgreSQL for numbers that mean something), then serves the same
+database twice: the Flask app on werkzeug's threaded server and
+asgi:application on uvicorn. Each server runs in its own process and is
+driven by `connections` (default 1000) keep-alive connections for
+`seconds` (default 10) cycling through GET /movies, /actors and
+/movies/<id>/actors with a Casting Assistant token from local_auth.py.
+Without uvicorn installed only the WSGI side runs.
+'''
+import asyncio
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+STARTER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, STARTER)
+DATABASE_URL = os.environ.get(
+    'BENCH_DATABASE_URL',
+    'sqlite:///' + os.path.join(tempfile.gettempdir(), 'bench_asgi.db'))
+os.environ['DATABASE_URL'] = DATABASE_URL
+os.environ['JWKS_BACKGROUND_REFRESH'] = 'false'
+
+from local_auth import JWKSServer, load_keys, mint_token  # noqa: E402
+
+WSGI_SERVER = '''
+import sys
+from werkzeug.serving import WSGIRequestHandler, make_server
+import app
+WSGIRequestHandler.protocol_version = 'HTTP/1.1'  # keep-alive
+WSGIRequestHandler.log_request = lambda *args, **kwargs: None
+make_server('127.0.0.1', int(sys.argv[1]), app.get_app(),
+            threaded=True).serve_forever()
+'''
+ASGI_SERVER = '''
+import sys
+import uvicorn
+uvicorn.run('asgi:application', host='127.0.0.1', port=int(sys.argv[1]),
+            log_level='warning', backlog=4096)
+'''
+PATHS = ('/movies', '/actors', '/movies/1/actors')
+
+
+def seed(rows):
+    """Tops the database up to `rows` movies and actors. Reruns only add
+    what is missing, and links only join rows added by this run, so the
+    unique link index never sees a pair twice.
+    """
+    import app
+    from models import Actor, Gender, Movie, MovieActor, db
+    with app.get_app().app_context():
+        movies = Movie.query.count()
+        if movies >= rows:
+            return
+        actors = Actor.query.count()
+        epoch = datetime(1950, 1, 1)
+        with db.engine.begin() as connection:
+            last_movie = connection.scalar(
+                db.select([db.func.max(Movie.id)])) or 0
+            last_actor = connection.scalar(
+                db.select([db.func.max(Actor.id)])) or 0
+            connection.execute(Movie.__table__.insert(), [
+                {'title': 'Movie {:07d}'.format(i),
+                 'release_date': epoch + timedelta(days=i)}
+                for i in range(movies, rows)])
+            if actors < rows:
+                connection.execute(Actor.__table__.insert(), [
+                    {'name': 'Actor {:07d}'.format(i), 'age': 20 + i % 60,
+                     'gender': Gender.FEMALE if i % 2 else Gender.MALE}
+                    for i in range(actors, rows)])
+            movie_id = connection.scalar(db.select(
+                [db.func.min(Movie.id)]).where(Movie.id > last_movie))
+            actor_ids = [row[0] for row in connection.execute(
+                db.select([Actor.id]).where(Actor.id > last_actor)
+                .order_by(Actor.id).limit(10))]
+            if actor_ids:
+                connection.execute(MovieActor.__table__.insert(), [
+                    {'movie_id': movie_id, 'actor_id': actor_id}
+                    for actor_id in actor_ids])
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(code, port, env):
+    process = subprocess.Popen(
+        [sys.executable, '-c', code, str(port)], cwd=STARTER, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('server exited with {}'.format(
+                process.returncode))
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('server did not start')
+
+
+async def worker(port, header, deadline, offset, latencies, errors):
+    connection = None
+    sent = offset
+    while time.monotonic() < deadline:
+        try:
+            if connection is None:
+                connection = await asyncio.open_connection('127.0.0.1', port)
+            reader, writer = connection
+            path = PATHS[sent % len(PATHS)]
+            sent += 1
+            started = time.perf_counter()
+            writer.write((
+                'GET {} HTTP/1.1\r\nHost: 127.0.0.1\r\n'
+                'Authorization: {}\r\n\r\n').format(path, header).encode())
+            head = await reader.readuntil(b'\r\n\r\n')
+            length, close = 0, False
+            for line in head.split(b'\r\n')[1:]:
+                name, _, value = line.partition(b':')
+                name = name.strip().lower()
+                if name == b'content-length':
+                    length = int(value)
+                elif name == b'connection':
+                    close = value.strip().lower() == b'close'
+            await reader.readexactly(length)
+            if head.split()[1] != b'200':
+                errors.append(head.split()[1])
+            latencies.append(time.perf_counter() - started)
+            if close:
+                writer.close()
+                connection = None
+        except (OSError, asyncio.IncompleteReadError):
+            errors.append(b'connection')
+            connection = None
+            await asyncio.sleep(0.01)
+    if connection is not None:
+        connection[1].close()
+
+
+async def load(port, header, connections, seconds):
+    latencies, errors = [], []
+    started = time.monotonic()
+    deadline = started + seconds
+    await asyncio.gather(*(
+        worker(port, header, deadline, i, latencies, errors)
+        for i in range(connections)))
+    elapsed = time.monotonic() - started
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99)] if latencies else 0
+    return len(latencies) / elapsed, p99 * 1000, len(errors)
+
+
+def main(connections=1000, seconds=10, rows=1000):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < connections * 2 + 64:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    seed(rows)
+    keys = load_keys()
+    servers = [('wsgi (werkzeug)', WSGI_SERVER)]
+    try:
+        import uvicorn  # noqa: F401
+        servers.append(('asgi (uvicorn)', ASGI_SERVER))
+    except ImportError:
+        print('uvicorn is not installed, skipping the ASGI server')
+
+    with JWKSServer(keys) as jwks:
+        env = dict(os.environ, JWKS_URL=jwks.url)
+        header = 'Bearer {}'.format(mint_token(keys, 'Casting Assistant'))
+        print('{} connections, {}s, {}'.format(
+            connections, seconds, DATABASE_URL))
+        print('{:<18} {:>10} {:>10} {:>8}'.format(
+            'server', 'r/s', 'p99 ms', 'errors'))
+        for name, code in servers:
+            port = free_port()
+            process = start_server(code, port, env)
+            try:
+                # warm the token cache and the connection pool
+                asyncio.run(load(port, header, 10, 1))
+                rate, p99, errors = asyncio.run(
+                    load(port, header, connections, seconds))
+            finally:
+                process.terminate()
+                process.wait()
+            print('{:<18} {:>10.1f} {:>10.1f} {:>8}'.format(
+                name, rate, p99, errors))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:4]))
@@ -0,0 +1,67 @@
+'''
+Offline auth throughput: requests/s through requires_auth for each role.
+
+    python benchmarks/bench_auth_throughput.py [requests]
+
+Runs entirely on this machine: tokens come from local_auth.py and the
+keys from its JWKS stand-in, no Auth0 and no database involved. "cold"
+clears the verified token cache before every request (full RS256
+verification), "warm" reuses it.
+'''
+import os
+import sys
+import time
+
+from flask import Flask, jsonify
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import auth  # noqa: E402
+from local_auth import JWKSServer, ROLES, load_keys, mint_token  # noqa: E402
+
+
+def make_app():
+    app = Flask(__name__)
+
+    @app.route('/movies')
+    @auth.requires_auth('get:movies')
+    def get_movies(payload):
+        return jsonify({'success': True})
+
+    @app.route('/movies/1/actors')
+    @auth.requires_auth('get:movies', 'get:actors')
+    def get_movie_actors(payload):
+        return jsonify({'success': True})
+
+    return app
+
+
+def measure(client, path, header, requests, cold):
+    started = time.perf_counter()
+    for _ in range(requests):
+        if cold:
+            auth.token_cache.clear()
+        res = client.get(path, headers={'Authorization': header})
+        assert res.status_code == 200, res.status_code
+    return requests / (time.perf_counter() - started)
+
+
+def main(requests=2000):
+    keys = load_keys()
+    with JWKSServer(keys) as server:
+        auth.jwks_cache.url = server.url
+        auth.jwks_cache.clear()
+        client = make_app().test_client()
+
+        print('{:<20} {:<18} {:>10} {:>10}'.format(
+            'role', 'route', 'cold r/s', 'warm r/s'))
+        for role in ROLES:
+            header = f'Bearer {mint_token(keys, role)}'
+            for path in ('/movies', '/movies/1/actors'):
+                cold = measure(client, path, header, requests, cold=True)
+                warm = measure(client, path, header, requests, cold=False)
+                print('{:<20} {:<18} {:>10.0f} {:>10.0f}'.format(
+                    role, path, cold, warm))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,202 @@
+'''
+Query plans and latency of the list/join queries before and after the
+catalog indexes migration (c47d9a1e2f35).
+
+    python benchmarks/bench_indexes.py [rows]
+
+Seeds `rows` (default 1,000,000) movies, as many actors and two links
+per movie into BENCH_DATABASE_URL (default a SQLite file in the temp
+directory), migrated to the revision before the indexes. Every query is
+explained and timed, then the database is upgraded to c47d9a1e2f35 and
+measured again. The cursor pages are not written out here: they are
+requested from the real app (create_app) and the SQL it sends is what
+gets timed, so a change to seek_elements shows up in the numbers. The database is wiped first, never point it at data you
+want to keep.
+'''
+import base64
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from flask import Flask
+from flask_migrate import Migrate, downgrade, upgrade
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+MIGRATIONS = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations')
+BEFORE, AFTER = '8e3f41c0a6b2', 'c47d9a1e2f35'
+DATABASE_URL = os.environ.get(
+    'BENCH_DATABASE_URL',
+    'sqlite:///' + os.path.join(tempfile.gettempdir(), 'bench_indexes.db'))
+BATCH = 10000
+# the app built for the cursor pages must leave the schema to migrations
+os.environ.update(DATABASE_URL=DATABASE_URL, DB_CREATE_ALL='false',
+                  JWKS_BACKGROUND_REFRESH='false')
+
+import auth  # noqa: E402
+from app import create_app  # noqa: E402
+from local_auth import JWKSServer, load_keys, mint_token  # noqa: E402
+from models import db  # noqa: E402
+
+# the statements behind each endpoint, with parameters deep in the table
+QUERIES = {
+    'GET /movies?page=': (
+        'SELECT id, title, release_date FROM movies '
+        'ORDER BY title, id LIMIT 3 OFFSET :offset'),
+    'GET /movies/<id>/actors': (
+        'SELECT actors.id, actors.name FROM actors '
+        'JOIN movies_actors ON actors.id = movies_actors.actor_id '
+        'WHERE movies_actors.movie_id = :id'),
+    'GET /actors?include=movies': (
+        'SELECT movies.id, movies.title FROM movies '
+        'JOIN movies_actors ON movies.id = movies_actors.movie_id '
+        'WHERE movies_actors.actor_id IN (:id, :id2, :id3)'),
+    'movies by release_date': (
+        'SELECT id, title FROM movies '
+        'WHERE release_date >= :since ORDER BY release_date LIMIT 3'),
+}
+
+
+def cursor(sort_value, last_id):
+    data = json.dumps([sort_value, last_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def app_queries(middle):
+    """{name: (sql, parameters)} the app sends for cursor pages deep in
+    the table, recorded from create_app()'s test client
+    """
+    paths = {
+        'GET /movies?cursor=': '/movies?cursor=' + cursor(
+            'Movie {:07d}'.format(middle), middle),
+        'GET /movies?cursor= (NULLs)': '/movies?cursor=' + cursor(
+            None, middle),
+        'GET /actors?cursor=': '/actors?cursor=' + cursor(
+            'Actor {:07d}'.format(middle), middle),
+    }
+    keys = load_keys()
+    header = {'Authorization': 'Bearer ' + mint_token(
+        keys, 'Casting Assistant')}
+    queries = {}
+    with JWKSServer(keys) as jwks:
+        auth.jwks_cache.url = jwks.url
+        client = create_app().test_client()
+        for name, path in paths.items():
+            statements = []
+
+            def record(conn, cursor, statement, parameters, *args):
+                # the page itself, not the ETag's table versions
+                if 'table_versions' not in statement:
+                    statements.append((statement, parameters))
+
+            event.listen(Engine, 'before_cursor_execute', record)
+            try:
+                res = client.get(path, headers=header)
+            finally:
+                event.remove(Engine, 'before_cursor_execute', record)
+            # the seed has no NULL titles, that page is an empty 404
+            assert res.status_code in (200, 404), (path, res.status_code)
+            for number, statement in enumerate(statements, 1):
+                label = name if len(statements) == 1 else '{} #{}'.format(
+                    name, number)
+                queries[label] = statement
+    return queries
+
+
+def make_app():
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    Migrate(app, db, directory=MIGRATIONS)
+    return app
+
+
+def seed(rows):
+    started = time.perf_counter()
+    epoch = datetime(1950, 1, 1)
+    with db.engine.begin() as connection:
+        for start in range(1, rows + 1, BATCH):
+            ids = range(start, min(start + BATCH, rows + 1))
+            connection.execute(
+                text('INSERT INTO movies (id, title, release_date) '
+                     'VALUES (:id, :title, :release_date)'),
+                [{'id': i, 'title': 'Movie {:07d}'.format(i * 7919 % rows),
+                  'release_date': epoch + timedelta(days=i % 25000)}
+                 for i in ids])
+            connection.execute(
+                text('INSERT INTO actors (id, name, age, gender) '
+                     'VALUES (:id, :name, :age, :gender)'),
+                [{'id': i, 'name': 'Actor {:07d}'.format(i * 7907 % rows),
+                  'age': 18 + i % 60, 'gender': 'FEMALE' if i % 2 else 'MALE'}
+                 for i in ids])
+            connection.execute(
+                text('INSERT INTO movies_actors (movie_id, actor_id) '
+                     'VALUES (:movie_id, :actor_id)'),
+                [{'movie_id': i, 'actor_id': actor_id}
+                 for i in ids for actor_id in (i, i % rows + 1)])
+    print('seeded {} movies/actors in {:.1f}s'.format(
+        rows, time.perf_counter() - started))
+
+
+def explain(connection, sql, params, raw=False):
+    # recorded statements are already in the driver's paramstyle
+    statement = str if raw else text
+    if db.engine.dialect.name == 'sqlite':
+        rows = connection.execute(
+            statement('EXPLAIN QUERY PLAN ' + sql), params)
+        return [row[-1] for row in rows]
+    return [row[0] for row in connection.execute(
+        statement('EXPLAIN ' + sql), params)]
+
+
+def measure(label, params, recorded, repeat=20):
+    print('\n== {} =='.format(label))
+    queries = [(name, sql, params, False) for name, sql in QUERIES.items()]
+    queries += [(name, sql, parameters, True)
+                for name, (sql, parameters) in recorded.items()]
+    with db.engine.connect() as connection:
+        for name, sql, parameters, raw in queries:
+            statement = sql if raw else text(sql)
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                connection.execute(statement, parameters).fetchall()
+                timings.append((time.perf_counter() - started) * 1000)
+            print('{:<28} median {:>9.3f} ms   max {:>9.3f} ms'.format(
+                name, statistics.median(timings), max(timings)))
+            for line in explain(connection, sql, parameters, raw):
+                print('    ' + line)
+
+
+def main(rows=1000000):
+    app = make_app()
+    with app.app_context():
+        downgrade(directory=MIGRATIONS, revision='base')
+        upgrade(directory=MIGRATIONS, revision=BEFORE)
+        seed(rows)
+        middle = rows // 2
+        params = {
+            'offset': middle, 'title': 'Movie {:07d}'.format(middle),
+            'name': 'Actor {:07d}'.format(middle), 'id': middle,
+            'id2': middle + 1, 'id3': middle + 2,
+            'since': datetime(2000, 1, 1),
+        }
+        recorded = app_queries(middle)
+        measure('before ({})'.format(BEFORE), params, recorded)
+        started = time.perf_counter()
+        upgrade(directory=MIGRATIONS, revision=AFTER)
+        print('\nbuilt indexes in {:.1f}s'.format(
+            time.perf_counter() - started))
+        measure('after ({})'.format(AFTER), params, recorded)
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,74 @@
+'''
+Serialization throughput of a 10k-item /movies or /actors payload.
+
+    python benchmarks/bench_json.py [items]
+
+Compares flask.jsonify (the app's default), fast_json with the stdlib
+fallback and fast_json with orjson, each building the full response
+inside an app context the way the routes do.
+'''
+import os
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+from flask import Flask, jsonify as flask_jsonify
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fast_json  # noqa: E402
+from models import Gender  # noqa: E402
+
+
+def payloads(items):
+    epoch = datetime(1950, 1, 1)
+    genders = list(Gender)
+    movies = [{'id': i, 'title': 'Movie {}'.format(i),
+               'release_date': epoch + timedelta(days=i)}
+              for i in range(items)]
+    actors = [{'id': i, 'name': 'Actor {}'.format(i), 'age': 18 + i % 60,
+               'gender': genders[i % len(genders)]}
+              for i in range(items)]
+    return {
+        'movies': {'success': True, 'movies': movies, 'status_code': 200},
+        'actors': {'success': True, 'actors': actors, 'status_code': 200},
+    }
+
+
+def main(items=10000):
+    app = Flask(__name__)
+    orjson = fast_json.orjson
+    encoders = [('flask.jsonify', flask_jsonify, False)]
+    fast_json.orjson = None
+    encoders.append(('fast_json stdlib', fast_json.jsonify, True))
+    encoders.append(('fast_json orjson', fast_json.jsonify, True))
+
+    print('{:<18} {:<8} {:>10} {:>12} {:>10}'.format(
+        'encoder', 'payload', 'ms', 'items/s', 'MB/s'))
+    for name, jsonify, fast in encoders:
+        if name == 'fast_json orjson':
+            if orjson is None:
+                print('{:<18} orjson is not installed'.format(name))
+                continue
+            fast_json.orjson = orjson
+        app.config['FAST_JSON'] = fast
+        with app.app_context():
+            for label, payload in payloads(items).items():
+                if not fast:
+                    # flask.jsonify can't encode enums, give it the value
+                    # the way Actor.format does
+                    payload = dict(payload, **{label: [
+                        dict(item, gender=item['gender'].value)
+                        if 'gender' in item else item
+                        for item in payload[label]]})
+                size = len(jsonify(payload).get_data())
+                best = min(timeit.repeat(
+                    lambda: jsonify(payload).get_data(), number=5, repeat=5))
+                seconds = best / 5
+                print('{:<18} {:<8} {:>10.2f} {:>12.0f} {:>10.1f}'.format(
+                    name, label, seconds * 1000, items / seconds,
+                    size / seconds / 1e6))
+    fast_json.orjson = orjson
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:2]))
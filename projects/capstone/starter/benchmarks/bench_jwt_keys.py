@@ -0,0 +1,43 @@
+'''
+Per-token verification latency: JWK dict vs pre-parsed key object.
+
+    python benchmarks/bench_jwt_keys.py [iterations]
+
+The "dict" column is what verify_decode_jwt used to do (hand the raw
+JWK to jwt.decode, which parses the modulus/exponent on every call),
+the "key object" column is the JWKSCache path.
+'''
+import os
+import sys
+import timeit
+
+from jose import jwt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from auth import AUTH0_DOMAIN, API_AUDIENCE  # noqa: E402
+from jwks import JWKSCache  # noqa: E402
+from local_auth import load_keys, mint_token  # noqa: E402
+
+ISSUER = f'https://{AUTH0_DOMAIN}/'
+AUDIENCE = API_AUDIENCE
+
+
+def main(iterations=2000):
+    keys = load_keys()
+    jwks = keys.jwks
+    key_dict = jwks['keys'][0]
+    key_object = JWKSCache('unused').parse_keys(jwks)[keys.kid]
+    token = mint_token(keys, 'Casting Assistant')
+
+    def decode_with(key):
+        return lambda: jwt.decode(token, key, algorithms=['RS256'],
+                                  audience=AUDIENCE, issuer=ISSUER)
+
+    print('{:<12} {:>12}'.format('key', 'us/token'))
+    for name, key in (('dict', key_dict), ('key object', key_object)):
+        best = min(timeit.repeat(decode_with(key), number=iterations, repeat=3))
+        print('{:<12} {:>12.1f}'.format(name, best / iterations * 1e6))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,100 @@
+'''
+ORM hydration vs column projection for the list endpoints.
+
+    python benchmarks/bench_projection.py [rows] [page size]
+
+Seeds `rows` (default 200,000) movies into a SQLite file in the temp
+directory and renders pages of `page size` (default 1000) rows two ways:
+"orm" is what /movies used to do (hydrate Movie instances, .format()
+each, copy the dicts again in format_movies), "projection" selects the
+three columns as plain rows and builds the dicts in one pass. Reports
+peak traced memory per row (tracemalloc) and pages/s including jsonify.
+'''
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from flask import Flask, jsonify
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models import Movie, db  # noqa: E402
+
+DATABASE_PATH = os.path.join(tempfile.gettempdir(), 'bench_projection.db')
+
+
+def seed(rows):
+    db.drop_all()
+    db.create_all()
+    epoch = datetime(1950, 1, 1)
+    with db.engine.begin() as connection:
+        connection.execute(Movie.__table__.insert(), [
+            {'title': 'Movie {:07d}'.format(i * 7919 % rows),
+             'release_date': epoch + timedelta(days=i % 25000)}
+            for i in range(rows)])
+
+
+def orm_page(offset, size):
+    movies = Movie.query.order_by(Movie.title, Movie.id).limit(
+        size).offset(offset).all()
+    formatted = [movie.format() for movie in movies]
+    page = []
+    for index in range(len(formatted)):
+        page.append({
+            'id': formatted[index]['id'],
+            'title': formatted[index]['title'],
+            'release_date': formatted[index]['release_date'],
+        })
+    db.session.remove()
+    return page
+
+
+def projection_page(offset, size):
+    rows = db.session.query(
+        Movie.id, Movie.title, Movie.release_date).order_by(
+        Movie.title, Movie.id).limit(size).offset(offset).all()
+    page = [{'id': movie_id, 'title': title, 'release_date': release_date}
+            for movie_id, title, release_date in rows]
+    db.session.remove()
+    return page
+
+
+def peak_per_row(render, size):
+    render(0, size)
+    tracemalloc.start()
+    render(size, size)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / size
+
+
+def pages_per_second(render, rows, size, seconds=3):
+    pages = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        offset = (pages * size) % max(rows - size, 1)
+        jsonify(movies=render(offset, size)).get_data()
+        pages += 1
+    return pages / (time.perf_counter() - started)
+
+
+def main(rows=200000, size=1000):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + DATABASE_PATH
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    with app.app_context():
+        seed(rows)
+        print('{:<12} {:>16} {:>10}'.format(
+            'path', 'peak bytes/row', 'pages/s'))
+        for name, render in (('orm', orm_page),
+                             ('projection', projection_page)):
+            print('{:<12} {:>16.0f} {:>10.1f}'.format(
+                name, peak_per_row(render, size),
+                pages_per_second(render, rows, size)))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,100 @@
+'''
+Per-worker vs shared token verification caching at 8 workers.
+
+    python benchmarks/bench_shared_token_cache.py [workers] [tokens] [requests]
+
+Every worker process serves `requests` calls drawn from the same pool of
+`tokens` bearer tokens, like a pre-fork server behind a load balancer.
+With per-worker caching each worker verifies every token itself, with
+the shared SQLite cache a token is verified once on the host.
+'''
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from jose import jwt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from auth import AUTH0_DOMAIN, API_AUDIENCE  # noqa: E402
+from jwks import JWKSCache  # noqa: E402
+from local_auth import load_keys, mint_token  # noqa: E402
+from token_cache import TokenCache, SharedTokenCache  # noqa: E402
+
+ISSUER = f'https://{AUTH0_DOMAIN}/'
+AUDIENCE = API_AUDIENCE
+
+
+def make_tokens(count):
+    keys = load_keys()
+    tokens = [mint_token(keys, 'Casting Assistant', subject=f'user-{i}')
+              for i in range(count)]
+    return keys.jwks, tokens
+
+
+def worker(jwks, tokens, requests, shared_path, seed, start):
+    cache = JWKSCache('unused')
+    public_key = next(iter(cache.parse_keys(jwks).values()))
+    local = TokenCache(maxsize=len(tokens))
+    shared = SharedTokenCache(shared_path) if shared_path else None
+    stream = random.Random(seed).choices(tokens, k=requests)
+    verifications = 0
+
+    start.wait()
+    started = time.perf_counter()
+    for token in stream:
+        payload = local.get(token)
+        if payload is None and shared is not None:
+            payload = shared.get(token)
+            if payload is not None:
+                local.put(token, payload)
+        if payload is None:
+            payload = jwt.decode(token, public_key, algorithms=['RS256'],
+                                 audience=AUDIENCE, issuer=ISSUER)
+            verifications += 1
+            local.put(token, payload)
+            if shared is not None:
+                shared.put(token, payload)
+    return verifications, time.perf_counter() - started
+
+
+def run(jwks, tokens, workers, requests, shared_path):
+    with multiprocessing.Manager() as manager:
+        start = manager.Event()
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.starmap_async(worker, [
+                (jwks, tokens, requests, shared_path, seed, start)
+                for seed in range(workers)])
+            time.sleep(0.5)
+            started = time.perf_counter()
+            start.set()
+            results = results.get()
+            wall = time.perf_counter() - started
+    verifications = sum(result[0] for result in results)
+    return verifications, wall
+
+
+def main(workers=8, token_count=2000, requests=5000):
+    jwks, tokens = make_tokens(token_count)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print('{} workers, {} tokens, {} requests per worker'.format(
+            workers, token_count, requests))
+        print('{:<12} {:>14} {:>10} {:>12}'.format(
+            'cache', 'verifications', 'wall s', 'requests/s'))
+        for name, shared_path in (
+                ('per-worker', None),
+                ('shared', os.path.join(tmpdir, 'tokens.sqlite'))):
+            verifications, wall = run(jwks, tokens, workers, requests,
+                                      shared_path)
+            print('{:<12} {:>14} {:>10.2f} {:>12.0f}'.format(
+                name, verifications, wall, workers * requests / wall))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:4]))
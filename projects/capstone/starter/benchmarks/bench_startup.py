@@ -0,0 +1,63 @@
+'''
+Import-to-first-request time of the capstone app.
+
+    python benchmarks/bench_startup.py [runs] [budget ms]
+
+Each run is a fresh interpreter that imports app, builds APP and serves
+GET /metrics through the test client; the time from before the import to
+the response is reported. "create_all" is the default startup,
+"migrations only" sets DB_CREATE_ALL=false as production does. Exits
+non-zero when the median of the latter exceeds the budget (default
+STARTUP_BUDGET_MS or 1000 ms), so it can run in CI.
+'''
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+STARTER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATABASE_URL = os.environ.get(
+    'BENCH_DATABASE_URL',
+    'sqlite:///' + os.path.join(tempfile.gettempdir(), 'bench_startup.db'))
+
+CHILD = '''
+import time
+started = time.perf_counter()
+import app
+response = app.APP.test_client().get('/metrics')
+assert response.status_code == 200, response.status_code
+print((time.perf_counter() - started) * 1000)
+'''
+
+
+def run(create_all):
+    env = dict(os.environ, DATABASE_URL=DATABASE_URL,
+               DB_CREATE_ALL='true' if create_all else 'false',
+               JWKS_BACKGROUND_REFRESH='false')
+    output = subprocess.run(
+        [sys.executable, '-c', CHILD], cwd=STARTER, env=env, check=True,
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+    return float(output.decode().split()[-1])
+
+
+def main(runs=5, budget=float(os.environ.get('STARTUP_BUDGET_MS', 1000))):
+    run(create_all=True)  # make sure the schema exists
+    print('{:<18} {:>10} {:>10}'.format('startup', 'median ms', 'max ms'))
+    medians = {}
+    for name, create_all in (('create_all', True),
+                             ('migrations only', False)):
+        timings = [run(create_all) for _ in range(runs)]
+        medians[name] = statistics.median(timings)
+        print('{:<18} {:>10.1f} {:>10.1f}'.format(
+            name, medians[name], max(timings)))
+
+    if medians['migrations only'] > budget:
+        print('over the {:.0f} ms budget'.format(budget))
+        sys.exit(1)
+    print('within the {:.0f} ms budget'.format(budget))
+
+
+if __name__ == '__main__':
+    main(*(float(arg) if i else int(arg)
+           for i, arg in enumerate(sys.argv[1:3])))
@@ -0,0 +1,244 @@
+'''
+`flask import-catalog`: bulk loads movies, actors or movie-actor links
+from CSV or NDJSON files, e.g.
+
+    FLASK_APP=app flask import-catalog movies movies.csv
+    FLASK_APP=app flask import-catalog movie_actor links.ndjson
+
+Files are read in chunks and written with the fastest path the backend
+has: COPY ... FROM STDIN on PostgreSQL, executemany elsewhere. The whole
+file is one transaction. Non-unique indexes of the target table are
+dropped for the load and rebuilt once at the end (--keep-indexes to
+skip that). Records may carry their own `id`; the PostgreSQL id
+sequence is moved past the imported ids. A record that doesn't parse
+stops the load with its file and line, and nothing is imported.
+'''
+import csv
+import io
+import itertools
+import json
+import os
+import time
+from datetime import datetime
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import inspect
+
+from models import db, Gender, TableVersion
+from response_cache import response_cache
+
+
+def parse_str(value):
+    return None if value in (None, '') else str(value)
+
+
+def parse_gender(value):
+    if value in (None, ''):
+        return None
+    if isinstance(value, Gender):
+        return value
+    try:
+        return Gender[value.upper()]
+    except KeyError:
+        return Gender(value)
+
+
+def parse_datetime(value):
+    if value in (None, '') or isinstance(value, datetime):
+        return value or None
+    return datetime.fromisoformat(value)
+
+
+def parse_int(value):
+    return None if value in (None, '') else int(value)
+
+
+# columns each kind accepts and how to read them from a record
+KINDS = {
+    'movies': {
+        'id': parse_int, 'title': parse_str, 'release_date': parse_datetime,
+    },
+    'actors': {
+        'id': parse_int, 'name': parse_str, 'age': parse_int,
+        'gender': parse_gender,
+    },
+    'movie_actor': {
+        'id': parse_int, 'movie_id': parse_int, 'actor_id': parse_int,
+    },
+}
+TABLES = {'movies': 'movies', 'actors': 'actors',
+          'movie_actor': 'movies_actors'}
+
+
+def read_records(path, file_format):
+    """Yields (line number, record) pairs
+    """
+    with open(path, newline='') as f:
+        if file_format == 'csv':
+            reader = csv.DictReader(f)
+            for record in reader:
+                yield reader.line_num, record
+            return
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                raise click.ClickException(
+                    '{}:{}: invalid JSON: {}'.format(path, number, e))
+            if not isinstance(record, dict):
+                raise click.ClickException(
+                    '{}:{}: expected an object'.format(path, number))
+            yield number, record
+
+
+def check_columns(parsers, record, where):
+    unknown = [str(column) for column in record if column not in parsers]
+    if unknown:
+        # a CSV row with more cells than the header shows up as None
+        raise click.ClickException(
+            '{}: unknown columns {}, expected {}'.format(
+                where, ', '.join(unknown), ', '.join(parsers)))
+
+
+def parse_record(parsers, fields, record, where):
+    check_columns(parsers, record, where)
+    try:
+        return [parsers[field](record.get(field)) for field in fields]
+    except (ValueError, TypeError, AttributeError) as e:
+        raise click.ClickException('{}: {}'.format(where, e))
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def copy_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Gender):
+        return value.name
+    return value
+
+
+def copy_rows(connection, table, fields, rows):
+    """COPY ... FROM STDIN the rows through the raw psycopg2 cursor
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([copy_value(value) for value in row])
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert('COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+            table.name, ', '.join(fields)), buffer)
+    finally:
+        cursor.close()
+
+
+def insert_rows(connection, table, fields, rows):
+    connection.execute(table.insert(), [dict(zip(fields, row))
+                                        for row in rows])
+
+
+def restore_indexes(engine, table, indexes):
+    """Recreates the deferred indexes a failed load left dropped. Only
+    needed where DDL isn't rolled back with the load (SQLite through
+    pysqlite runs it outside the transaction).
+    """
+    existing = {index['name'] for index in
+                inspect(engine).get_indexes(table.name)}
+    for index in indexes:
+        if index.name not in existing:
+            index.create(engine)
+
+
+def import_file(kind, path, file_format=None, chunk_size=10000,
+                defer_indexes=True, echo=click.echo):
+    """Loads `path` into the table of `kind`, returns the row count
+    """
+    if file_format is None:
+        file_format = 'csv' if path.endswith('.csv') else 'ndjson'
+    parsers = KINDS[kind]
+    table = db.metadata.tables[TABLES[kind]]
+    engine = db.engine
+    write = (copy_rows if engine.dialect.name == 'postgresql'
+             else insert_rows)
+    records = read_records(path, file_format)
+    first = next(records, None)
+    if first is None:
+        echo('{}: {} is empty'.format(kind, path))
+        return 0
+    check_columns(parsers, first[1], '{}:{}'.format(path, first[0]))
+    fields = [field for field in parsers if field in first[1]]
+    if not fields:
+        raise click.ClickException('{}:{}: no {} columns, expected {}'.format(
+            path, first[0], kind, ', '.join(parsers)))
+    records = itertools.chain([first], records)
+
+    deferred = [index for index in table.indexes if not index.unique]
+    started = time.perf_counter()
+    total = 0
+    try:
+        with engine.begin() as connection:
+            if defer_indexes:
+                for index in deferred:
+                    index.drop(connection)
+            for chunk in chunked(records, chunk_size):
+                rows = [parse_record(parsers, fields, record,
+                                     '{}:{}'.format(path, number))
+                        for number, record in chunk]
+                write(connection, table, fields, rows)
+                total += len(rows)
+                echo('{}: {} rows, {:.0f} rows/s'.format(
+                    kind, total, total / (time.perf_counter() - started)))
+            if defer_indexes:
+                index_started = time.perf_counter()
+                for index in deferred:
+                    index.create(connection)
+                if deferred:
+                    echo('{}: rebuilt {} indexes in {:.1f}s'.format(
+                        kind, len(deferred),
+                        time.perf_counter() - index_started))
+            if 'id' in fields and engine.dialect.name == 'postgresql':
+                connection.execute(
+                    "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+                    "(SELECT MAX(id) FROM {0}))".format(table.name))
+            connection.execute(
+                TableVersion.__table__.update()
+                .where(TableVersion.name == table.name)
+                .values(version=TableVersion.version + 1))
+    except Exception:
+        if defer_indexes:
+            restore_indexes(engine, table, deferred)
+        raise
+    response_cache.bump(table.name)
+    elapsed = time.perf_counter() - started
+    echo('{}: imported {} rows in {:.1f}s ({:.0f} rows/s)'.format(
+        kind, total, elapsed, total / elapsed if elapsed else total))
+    return total
+
+
+@click.command('import-catalog')
+@click.argument('kind', type=click.Choice(sorted(KINDS)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'ndjson']),
+              help='Defaults to the file extension, .csv or NDJSON.')
+@click.option('--chunk-size', default=int(os.environ.get(
+    'IMPORT_CHUNK_SIZE', 10000)), show_default=True,
+    help='Records read and written per batch.')
+@click.option('--defer-indexes/--keep-indexes', default=True,
+              show_default=True,
+              help='Drop non-unique indexes during the load.')
+@with_appcontext
+def import_catalog(kind, path, file_format, chunk_size, defer_indexes):
+    """Bulk load KIND records (movies, actors, movie_actor) from PATH."""
+    import_file(kind, path, file_format, chunk_size, defer_indexes)
@@ -0,0 +1,100 @@
+import os
+import threading
+import time
+
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+import metrics
+
+
+'''
+TimedQueuePool
+    QueuePool that records how long each checkout waited for a
+    connection (including opening a new one) into the
+    metrics.histogram('db_pool', 'wait') histogram, and counts checkouts
+    that timed out.
+'''
+class TimedQueuePool(QueuePool):
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            _count('timeouts')
+            raise
+        finally:
+            metrics.histogram('db_pool', 'wait').observe(
+                (time.perf_counter() - started) * 1000)
+
+
+_counters = {'connects': 0, 'checkouts': 0, 'checkins': 0,
+             'invalidations': 0, 'timeouts': 0}
+_lock = threading.Lock()
+
+
+def _count(name):
+    with _lock:
+        _counters[name] += 1
+
+
+@event.listens_for(TimedQueuePool, 'connect')
+def _on_connect(dbapi_connection, connection_record):
+    _count('connects')
+
+
+@event.listens_for(TimedQueuePool, 'checkout')
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    _count('checkouts')
+
+
+@event.listens_for(TimedQueuePool, 'checkin')
+def _on_checkin(dbapi_connection, connection_record):
+    _count('checkins')
+
+
+@event.listens_for(TimedQueuePool, 'invalidate')
+def _on_invalidate(dbapi_connection, connection_record, exception):
+    _count('invalidations')
+
+
+def _flag(name, default):
+    return os.environ.get(name, default).lower() in ('1', 'true', 'yes')
+
+
+def engine_options(database_path):
+    """SQLALCHEMY_ENGINE_OPTIONS from the environment:
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT (seconds to wait for a
+    connection), DB_POOL_RECYCLE (seconds, -1 never) and DB_POOL_PRE_PING.
+    SQLite keeps SQLAlchemy's own pool, the settings don't apply to it.
+    """
+    if database_path.startswith('sqlite'):
+        return {}
+    return {
+        'poolclass': TimedQueuePool,
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', -1)),
+        'pool_pre_ping': _flag('DB_POOL_PRE_PING', 'false'),
+    }
+
+
+def stats(engine):
+    """Live state of the engine's pool plus the process-wide counters
+    and checkout wait histogram
+    """
+    pool = engine.pool
+    result = {'pool': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        result.update({
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'checked_in': pool.checkedin(),
+            'overflow': pool.overflow(),
+            'timeout': pool.timeout(),
+        })
+    with _lock:
+        result.update(_counters)
+    result['wait'] = metrics.histogram('db_pool', 'wait').snapshot()
+    return result
@@ -0,0 +1,95 @@
+'''
+Fast JSON responses for the capstone app.
+
+orjson (optional, `pip install orjson`) encodes straight to bytes and
+handles datetime and Enum natively; without it the stdlib encoder is used
+with the same conversions, so the output is the same either way:
+datetimes as ISO 8601 and enums as their value. Flask's own encoder writes
+datetimes as HTTP dates instead, which is why this is opt-in per app
+(FAST_JSON=true, see create_app).
+'''
+import enum
+import json
+from datetime import date, datetime
+
+from flask import current_app, jsonify as flask_jsonify
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depends on the environment
+    orjson = None
+
+try:
+    from flask.json.provider import JSONProvider
+except ImportError:  # Flask < 2.2
+    JSONProvider = None
+
+
+def _default(obj):
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, enum.Enum):
+        return obj.value
+    raise TypeError(f'{type(obj).__name__} is not JSON serializable')
+
+
+def dumps(obj):
+    """Encodes `obj` to JSON bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default)
+    return json.dumps(obj, default=_default, separators=(',', ':'),
+                      ensure_ascii=False).encode()
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _payload(args, kwargs):
+    # the same argument handling as flask.jsonify
+    if args and kwargs:
+        raise TypeError(
+            'jsonify() behavior undefined when passed both args and kwargs')
+    if len(args) == 1:
+        return args[0]
+    return args or kwargs
+
+
+def jsonify(*args, **kwargs):
+    """Drop-in for flask.jsonify: the fast encoder when the current app
+    has FAST_JSON set, flask.jsonify otherwise
+    """
+    if not current_app.config.get('FAST_JSON'):
+        return flask_jsonify(*args, **kwargs)
+    return current_app.response_class(
+        dumps(_payload(args, kwargs)) + b'\n', mimetype='application/json')
+
+
+if JSONProvider is not None:
+    '''
+    FastJSONProvider
+        app.json provider for Flask >= 2.2, so flask.jsonify and
+        request.get_json go through the fast encoder as well
+    '''
+    class FastJSONProvider(JSONProvider):
+        def dumps(self, obj, **kwargs):
+            return dumps(obj).decode()
+
+        def loads(self, s, **kwargs):
+            return loads(s)
+
+        def response(self, *args, **kwargs):
+            return self._app.response_class(
+                dumps(_payload(args, kwargs)) + b'\n',
+                mimetype='application/json')
+
+
+def init_app(app):
+    """Switches `app` to the fast encoder
+    """
+    app.config['FAST_JSON'] = True
+    if JSONProvider is not None:
+        app.json = FastJSONProvider(app)
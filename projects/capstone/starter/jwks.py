@@ -0,0 +1,203 @@
+import json
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlparse
+from urllib.request import urlopen
+from jose import jwk
+
+
+logger = logging.getLogger(__name__)
+
+'''
+JWKSCache
+    process-wide store for the identity provider signing keys.
+    The key set is fetched once and kept for `ttl` seconds. A token with
+    an unknown `kid` triggers a refetch (key rotation), but never more
+    often than every `min_refresh_interval` seconds so a flood of bogus
+    kids can't turn into a fetch storm against the provider.
+    `url` may be an http(s) URL, a file:// URL or a plain path to a
+    local JWKS file.
+    Every JWK is parsed into a ready-to-use public key object once, at
+    fetch time, so verifying a token doesn't rebuild the key from its
+    modulus and exponent.
+    If a refresh fails the last-known-good keys keep being served for
+    `grace` seconds past their ttl. With start_refresher() a daemon
+    thread renews the keys ahead of expiry (at `refresh_ahead` * ttl) and
+    request threads stop fetching altogether, they only block on the
+    provider when there are no usable keys at all.
+'''
+class JWKSCache:
+    def __init__(self, url, ttl=600, min_refresh_interval=30, timeout=5,
+                 algorithm='RS256', grace=3600, refresh_ahead=0.8):
+        self.url = url
+        self.algorithm = algorithm
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.grace = grace
+        self.refresh_ahead = refresh_ahead
+        self.fetch_count = 0
+        self.failure_count = 0
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._lock = threading.Lock()
+        self._refresher = None
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+
+    def fetch(self):
+        """Downloads and parses the JWKS document
+        """
+        if urlparse(self.url).scheme in ('http', 'https', 'file'):
+            with urlopen(self.url, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        with open(os.path.expanduser(self.url), 'rb') as f:
+            return json.loads(f.read())
+
+    def refresh(self):
+        """Refetches the key set and replaces the cached keys
+        """
+        self._last_attempt = time.monotonic()
+        try:
+            keys = self.parse_keys(self.fetch())
+        except Exception:
+            self.failure_count += 1
+            raise
+        self.fetch_count += 1
+        self._keys = keys
+        self._fetched_at = time.monotonic()
+
+    def try_refresh(self):
+        """Refreshes the key set, keeping the current keys on failure
+        """
+        try:
+            self.refresh()
+            return True
+        except Exception:
+            logger.warning('JWKS refresh from %s failed, serving the '
+                           'last-known-good keys', self.url, exc_info=True)
+            return False
+
+    def parse_keys(self, jwks):
+        """Builds the kid -> public key object index for a JWKS document
+        """
+        keys = {}
+        for key in jwks.get('keys', []):
+            if 'kid' not in key or key.get('use', 'sig') != 'sig':
+                continue
+            try:
+                keys[key['kid']] = jwk.construct(key, self.algorithm)
+            except Exception:
+                # keys we can't use (other key types, broken entries)
+                # are simply not indexed
+                continue
+        return keys
+
+    def expired(self, now=None):
+        if self._fetched_at is None:
+            return True
+        now = time.monotonic() if now is None else now
+        return now - self._fetched_at >= self.ttl
+
+    def usable(self, now=None):
+        """True while the keys are fresh, or stale but within the grace
+        window
+        """
+        if self._fetched_at is None:
+            return False
+        now = time.monotonic() if now is None else now
+        return now - self._fetched_at < self.ttl + self.grace
+
+    def _may_refetch(self, now):
+        return (self._last_attempt is None
+                or now - self._last_attempt >= self.min_refresh_interval)
+
+    def _refresh_inline(self):
+        with self._lock:
+            if not self.expired():
+                return
+            if self.usable():
+                self.try_refresh()
+            else:
+                # nothing left to fall back to
+                self.refresh()
+
+    def get_key(self, kid):
+        """Returns the public key object for `kid`, or None if the provider
+        doesn't know it
+        """
+        now = time.monotonic()
+        if self.expired(now):
+            if not self.usable(now):
+                self._refresh_inline()
+            elif not self.refreshing and self._may_refetch(now):
+                self._refresh_inline()
+
+        key = self._keys.get(kid)
+        if key is None and self._may_refetch(now):
+            if self.refreshing:
+                # let the refresher pick up a rotated key set, the
+                # request thread doesn't wait on the provider
+                self._wakeup.set()
+                return None
+            with self._lock:
+                key = self._keys.get(kid)
+                if key is None and self._may_refetch(time.monotonic()):
+                    self.try_refresh()
+                    key = self._keys.get(kid)
+        return key
+
+    @property
+    def refreshing(self):
+        return self._refresher is not None and self._refresher.is_alive()
+
+    def start_refresher(self):
+        """Starts the background refresher thread, once per process
+        """
+        with self._lock:
+            if self.refreshing:
+                return
+            self._stop.clear()
+            self._refresher = threading.Thread(
+                target=self._run, name='jwks-refresher', daemon=True)
+            self._refresher.start()
+
+    def stop_refresher(self):
+        refresher = self._refresher
+        self._stop.set()
+        self._wakeup.set()
+        if refresher is not None:
+            refresher.join()
+        self._refresher = None
+
+    def _next_refresh(self):
+        if self._last_attempt is None:
+            return time.monotonic()
+        if self._fetched_at is None or self._last_attempt > self._fetched_at:
+            # the last attempt failed, retry without hammering the provider
+            return self._last_attempt + max(self.min_refresh_interval, 1)
+        return self._fetched_at + self.ttl * self.refresh_ahead
+
+    def _run(self):
+        if self._fetched_at is None:
+            with self._lock:
+                self.try_refresh()
+        while not self._stop.is_set():
+            delay = self._next_refresh() - time.monotonic()
+            woken = self._wakeup.wait(max(delay, 0))
+            self._wakeup.clear()
+            if self._stop.is_set():
+                return
+            if woken and not self._may_refetch(time.monotonic()):
+                continue
+            with self._lock:
+                self.try_refresh()
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._fetched_at = None
+            self._last_attempt = None
@@ -0,0 +1,199 @@
+'''
+Offline stand-in for Auth0: a local signing key pair, a token minter for
+the casting agency roles and a tiny JWKS server.
+
+    python local_auth.py serve [--port 8765]
+        serves the local JWKS at http://127.0.0.1:8765/.well-known/jwks.json
+    python local_auth.py token "Casting Director" [--expires-in 3600]
+        prints a signed bearer token for the role
+
+Keys are generated once into LOCAL_AUTH_DIR (default .local_auth next
+to this file). Tokens are minted for the configured AUTH0_DOMAIN and
+audience, so either keep the real domain and set JWKS_URL to the local
+server, or run the API, the minter and the server all with
+AUTH0_DOMAIN=127.0.0.1:8765.
+'''
+import argparse
+import json
+import os
+import threading
+import time
+import uuid
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import rsa
+from jose import jwk, jwt
+
+from auth import AUTH0_DOMAIN, API_AUDIENCE
+
+
+KEYS_DIR = os.environ.get(
+    'LOCAL_AUTH_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.local_auth'))
+
+ROLES = {
+    'Casting Assistant': [
+        'get:actors', 'get:movies',
+    ],
+    'Casting Director': [
+        'delete:actors', 'get:actors', 'get:movies', 'patch:actors',
+        'patch:movies', 'post:actors',
+    ],
+    'Executive Producer': [
+        'delete:actors', 'delete:movies', 'get:actors', 'get:movies',
+        'patch:actors', 'patch:movies', 'post:actors', 'post:movies',
+    ],
+}
+
+
+class LocalKeys:
+    def __init__(self, kid, private_pem, public_pem):
+        self.kid = kid
+        self.private_pem = private_pem
+        self.public_pem = public_pem
+        self._signing_key = None
+
+    @property
+    def signing_key(self):
+        if self._signing_key is None:
+            self._signing_key = jwk.construct(self.private_pem, 'RS256')
+        return self._signing_key
+
+    @property
+    def jwks(self):
+        key = jwk.construct(self.public_pem, 'RS256').to_dict()
+        key.update({'kid': self.kid, 'use': 'sig', 'alg': 'RS256'})
+        return {'keys': [key]}
+
+
+def generate_keys(bits=2048, kid=None):
+    public_key, private_key = rsa.newkeys(bits)
+    return LocalKeys(kid or uuid.uuid4().hex,
+                     private_key.save_pkcs1().decode(),
+                     public_key.save_pkcs1().decode())
+
+
+def load_keys(directory=KEYS_DIR):
+    """Loads the key pair from `directory`, generating it on first use
+    """
+    private_path = os.path.join(directory, 'private.pem')
+    meta_path = os.path.join(directory, 'key.json')
+    if not os.path.exists(private_path):
+        keys = generate_keys()
+        os.makedirs(directory, exist_ok=True)
+        fd = os.open(private_path, os.O_WRONLY | os.O_CREAT, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(keys.private_pem)
+        with open(meta_path, 'w') as f:
+            json.dump({'kid': keys.kid, 'public_pem': keys.public_pem}, f)
+        with open(os.path.join(directory, 'jwks.json'), 'w') as f:
+            json.dump(keys.jwks, f)
+        return keys
+
+    with open(private_path) as f:
+        private_pem = f.read()
+    with open(meta_path) as f:
+        meta = json.load(f)
+    return LocalKeys(meta['kid'], private_pem, meta['public_pem'])
+
+
+def mint_token(keys, role=None, permissions=None, expires_in=3600,
+               subject=None, **claims):
+    """Signs a token for `role` (one of ROLES) or an explicit permission
+    list, shaped like the Auth0 access tokens the API expects
+    """
+    if permissions is None:
+        permissions = ROLES[role]
+    now = int(time.time())
+    payload = {
+        'iss': f'https://{AUTH0_DOMAIN}/',
+        'sub': subject or 'local|{}'.format(
+            (role or 'user').lower().replace(' ', '-')),
+        'aud': API_AUDIENCE,
+        'iat': now,
+        'exp': now + expires_in,
+        'scope': '',
+        'permissions': list(permissions),
+    }
+    payload.update(claims)
+    return jwt.encode(payload, keys.signing_key, algorithm='RS256',
+                      headers={'kid': keys.kid})
+
+
+'''
+JWKSServer
+    serves the local key set at /.well-known/jwks.json from a daemon
+    thread, port 0 picks a free port
+'''
+class JWKSServer:
+    def __init__(self, keys, host='127.0.0.1', port=0):
+        body = json.dumps(keys.jwks).encode()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/.well-known/jwks.json':
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer((host, port), Handler)
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/.well-known/jwks.json'
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8765)
+    token = commands.add_parser('token')
+    token.add_argument('role', choices=sorted(ROLES))
+    token.add_argument('--expires-in', type=int, default=3600)
+    args = parser.parse_args()
+
+    keys = load_keys()
+    if args.command == 'token':
+        print(mint_token(keys, args.role, expires_in=args.expires_in))
+        return
+
+    server = JWKSServer(keys, args.host, args.port)
+    print(f'serving {server.url}')
+    print(f'export JWKS_URL={server.url}')
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import bisect
+import threading
+
+
+'''
+Histogram
+    fixed-bucket latency histogram, values in milliseconds.
+    Buckets are cumulative upper bounds like Prometheus' `le`.
+'''
+class Histogram:
+    BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100,
+               250, 500, 1000, 2500, 5000)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self):
+        with self._lock:
+            cumulative = 0
+            buckets = {}
+            for bound, count in zip(self.buckets, self.counts):
+                cumulative += count
+                buckets[str(bound)] = cumulative
+            buckets['+Inf'] = self.count
+            return {
+                'count': self.count,
+                'sum_ms': round(self.sum, 3),
+                'p50_ms': self.quantile(0.5),
+                'p99_ms': self.quantile(0.99),
+                'buckets': buckets,
+            }
+
+
+_histograms = {}
+_lock = threading.Lock()
+
+
+def histogram(group, *labels):
+    """Returns the process-wide histogram for `group` and `labels`,
+    creating it on first use
+    """
+    key = (group,) + labels
+    found = _histograms.get(key)
+    if found is None:
+        with _lock:
+            found = _histograms.setdefault(key, Histogram())
+    return found
+
+
+def snapshot(group):
+    """Snapshots of every histogram in `group`, nested by label
+    """
+    result = {}
+    for key, found in list(_histograms.items()):
+        if key[0] != group:
+            continue
+        node = result
+        for label in key[1:-1]:
+            node = node.setdefault(label, {})
+        node[key[-1] if len(key) > 1 else group] = found.snapshot()
+    return result
+
+
+def reset(group=None):
+    with _lock:
+        for key in list(_histograms):
+            if group is None or key[0] == group:
+                del _histograms[key]
@@ -0,0 +1,30 @@
+"""unique movie actor links
+
+Revision ID: 8e3f41c0a6b2
+Revises: 5a1c2e9b7d01
+Create Date: 2026-10-18 19:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e3f41c0a6b2'
+down_revision = '5a1c2e9b7d01'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # keep the oldest row of every duplicated link so the index can build
+    op.execute(
+        'DELETE FROM movies_actors WHERE id NOT IN '
+        '(SELECT MIN(id) FROM movies_actors GROUP BY movie_id, actor_id)')
+    op.create_index('ix_movies_actors_movie_id_actor_id', 'movies_actors',
+                    ['movie_id', 'actor_id'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_movies_actors_movie_id_actor_id',
+                  table_name='movies_actors')
@@ -0,0 +1,62 @@
+"""catalog indexes
+
+Revision ID: c47d9a1e2f35
+Revises: 8e3f41c0a6b2
+Create Date: 2026-10-18 19:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c47d9a1e2f35'
+down_revision = '8e3f41c0a6b2'
+branch_labels = None
+depends_on = None
+
+# names the unnamed foreign keys of create_all/SQLite databases the way
+# PostgreSQL names them by default, so one set of names works on both
+naming_convention = {
+    'fk': '%(table_name)s_%(column_0_name)s_fkey',
+}
+
+
+def upgrade():
+    # (title, id) and (name, id) serve the ORDER BY of both pagination
+    # modes and the keyset seek; movies_actors.movie_id is already the
+    # leading column of ix_movies_actors_movie_id_actor_id
+    op.create_index('ix_movies_title_id', 'movies', ['title', 'id'])
+    op.create_index('ix_movies_release_date', 'movies', ['release_date'])
+    op.create_index('ix_actors_name_id', 'actors', ['name', 'id'])
+    op.create_index('ix_movies_actors_actor_id', 'movies_actors',
+                    ['actor_id'])
+    with op.batch_alter_table(
+            'movies_actors', naming_convention=naming_convention) as batch_op:
+        batch_op.drop_constraint('movies_actors_movie_id_fkey',
+                                 type_='foreignkey')
+        batch_op.drop_constraint('movies_actors_actor_id_fkey',
+                                 type_='foreignkey')
+        batch_op.create_foreign_key(
+            'movies_actors_movie_id_fkey', 'movies', ['movie_id'], ['id'],
+            ondelete='CASCADE')
+        batch_op.create_foreign_key(
+            'movies_actors_actor_id_fkey', 'actors', ['actor_id'], ['id'],
+            ondelete='CASCADE')
+
+
+def downgrade():
+    with op.batch_alter_table(
+            'movies_actors', naming_convention=naming_convention) as batch_op:
+        batch_op.drop_constraint('movies_actors_movie_id_fkey',
+                                 type_='foreignkey')
+        batch_op.drop_constraint('movies_actors_actor_id_fkey',
+                                 type_='foreignkey')
+        batch_op.create_foreign_key(
+            'movies_actors_movie_id_fkey', 'movies', ['movie_id'], ['id'])
+        batch_op.create_foreign_key(
+            'movies_actors_actor_id_fkey', 'actors', ['actor_id'], ['id'])
+    op.drop_index('ix_movies_actors_actor_id', table_name='movies_actors')
+    op.drop_index('ix_actors_name_id', table_name='actors')
+    op.drop_index('ix_movies_release_date', table_name='movies')
+    op.drop_index('ix_movies_title_id', table_name='movies')
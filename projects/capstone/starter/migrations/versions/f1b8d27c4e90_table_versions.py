@@ -0,0 +1,32 @@
+"""table versions
+
+Revision ID: f1b8d27c4e90
+Revises: c47d9a1e2f35
+Create Date: 2026-10-18 20:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1b8d27c4e90'
+down_revision = 'c47d9a1e2f35'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table_versions = op.create_table('table_versions',
+    sa.Column('name', sa.String(length=64), nullable=False),
+    sa.Column('version', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(table_versions, [
+        {'name': name, 'version': 0}
+        for name in ('movies', 'actors', 'movies_actors')
+    ])
+
+
+def downgrade():
+    op.drop_table('table_versions')
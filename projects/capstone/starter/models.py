@@ -1,9 +1,13 @@
 import enum
 import os
 from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
 from flask_moment import Moment
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import relationship, backref
+from response_cache import response_cache
+import db_pool
 
 
 
@@ -11,7 +15,17 @@ DATABASE_NAME = "agency"
 username = 'postgres'
 password = '123456'
 url = 'localhost:5432'
-database_path = "postgres://{}:{}@{}/{}".format(username, password, url, DATABASE_NAME)
+database_path = os.environ.get(
+    'DATABASE_URL',
+    "postgres://{}:{}@{}/{}".format(username, password, url, DATABASE_NAME))
+
+# The schema is created at startup unless DB_CREATE_ALL=false; production
+# leaves it to the migrations (flask db upgrade) and skips the round trips.
+# Flask CLI commands never create it, so `flask db upgrade` starts from an
+# empty database. A database created by create_all is brought under the
+# migrations once with `flask db stamp head`.
+DB_CREATE_ALL = os.environ.get(
+    'DB_CREATE_ALL', 'true').lower() in ('1', 'true', 'yes')
 
 db = SQLAlchemy()
 moment = Moment()
@@ -24,10 +38,51 @@ setup_db(app)
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = db_pool.engine_options(
+        database_path)
     db.app = app
-    migrate = Migrate(app, db)
+    from_cli = os.environ.get('FLASK_RUN_FROM_CLI') == 'true'
+    if from_cli:
+        # only the flask CLI (flask db ...) needs Flask-Migrate, and
+        # importing it pulls in all of alembic
+        from flask_migrate import Migrate
+        migrate = Migrate(app, db)
     db.init_app(app)
-    db.create_all()
+    if DB_CREATE_ALL and not from_cli:
+        db.create_all()
+
+'''
+bulk_insert(model, rows)
+    inserts `rows` (dicts of column values) in one transaction and
+    returns their ids in input order
+'''
+
+
+def bulk_insert(model, rows):
+    table = model.__table__
+    try:
+        if db.engine.dialect.name == 'postgresql':
+            # PostgreSQL doesn't promise RETURNING rows in VALUES order, so
+            # the ids are reserved from the sequence first and paired with
+            # the rows here, then written with one multi-row INSERT
+            ids = sorted(row[0] for row in db.session.execute(
+                "SELECT nextval(pg_get_serial_sequence(:table, 'id')) "
+                "FROM generate_series(1, :count)",
+                {'table': table.name, 'count': len(rows)}))
+            db.session.execute(table.insert().values(
+                [dict(row, id=id) for row, id in zip(rows, ids)]))
+        else:
+            elements = [model(**row) for row in rows]
+            db.session.add_all(elements)
+            db.session.flush()
+            ids = [element.id for element in elements]
+        touch(table.name)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    response_cache.bump(table.name)
+    return ids
 
 '''
 Movie
@@ -43,10 +98,13 @@ class Gender(enum.Enum):
 
 class Movie(db.Model):
     __tablename__ = 'movies'
+    __table_args__ = (
+        db.Index('ix_movies_title_id', 'title', 'id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(250))
-    release_date = db.Column(db.DateTime)
+    release_date = db.Column(db.DateTime, index=True)
     actors = db.relationship('Actor',secondary='movies_actors')
 
 
@@ -56,14 +114,20 @@ class Movie(db.Model):
 
     def insert(self):
         db.session.add(self)
+        touch(self.__tablename__)
         db.session.commit()
+        response_cache.bump(self.__tablename__)
 
     def update(self):
+        touch(self.__tablename__)
         db.session.commit()
+        response_cache.bump(self.__tablename__)
 
     def delete(self):
         db.session.delete(self)
+        touch(self.__tablename__, 'movies_actors')
         db.session.commit()
+        response_cache.bump(self.__tablename__, 'movies_actors')
 
     def format(self):
         return {
@@ -79,6 +143,9 @@ Actor
 '''
 class Actor(db.Model):
     __tablename__ = 'actors'
+    __table_args__ = (
+        db.Index('ix_actors_name_id', 'name', 'id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(250))
@@ -96,14 +163,20 @@ class Actor(db.Model):
 
     def insert(self):
         db.session.add(self)
+        touch(self.__tablename__)
         db.session.commit()
+        response_cache.bump(self.__tablename__)
 
     def update(self):
+        touch(self.__tablename__)
         db.session.commit()
+        response_cache.bump(self.__tablename__)
 
     def delete(self):
         db.session.delete(self)
+        touch(self.__tablename__, 'movies_actors')
         db.session.commit()
+        response_cache.bump(self.__tablename__, 'movies_actors')
 
     def format(self):
         return {
@@ -116,24 +189,123 @@ class Actor(db.Model):
 
 class MovieActor(db.Model):
     __tablename__ = 'movies_actors'
+    __table_args__ = (
+        db.Index('ix_movies_actors_movie_id_actor_id',
+                 'movie_id', 'actor_id', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    movie_id = db.Column(db.Integer, db.ForeignKey('movies.id'))
-    actor_id = db.Column(db.Integer, db.ForeignKey('actors.id'))
+    movie_id = db.Column(
+        db.Integer, db.ForeignKey('movies.id', ondelete='CASCADE'))
+    actor_id = db.Column(
+        db.Integer, db.ForeignKey('actors.id', ondelete='CASCADE'),
+        index=True)
    
     def insert(self):
         db.session.add(self)
+        touch(self.__tablename__)
         db.session.commit()
+        response_cache.bump(self.__tablename__)
 
     def update(self):
+        touch(self.__tablename__)
         db.session.commit()
+        response_cache.bump(self.__tablename__)
 
     def delete(self):
         db.session.delete(self)
+        touch(self.__tablename__)
         db.session.commit()
+        response_cache.bump(self.__tablename__)
 
     def format(self):
         return {
           'id': self.id,
           'movie_id': self.movie_id,
           'actor_id': self.actor_id,
-        }
\ No newline at end of file
+        }
+
+
+
+'''
+TableVersion
+    one row per catalog table whose version is incremented in the same
+    transaction as every write to that table, so the version read by any
+    worker identifies the table's committed contents (used for ETags)
+'''
+class TableVersion(db.Model):
+    __tablename__ = 'table_versions'
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+VERSIONED_TABLES = ('movies', 'actors', 'movies_actors')
+
+
+@event.listens_for(TableVersion.__table__, 'after_create')
+def insert_table_versions(target, connection, **kw):
+    connection.execute(target.insert(), [
+        {'name': name, 'version': 0} for name in VERSIONED_TABLES])
+
+
+def touch(*tables):
+    """Increments the version of `tables` in the current transaction
+    """
+    db.session.execute(
+        TableVersion.__table__.update()
+        .where(TableVersion.name.in_(tables))
+        .values(version=TableVersion.version + 1))
+
+
+def table_versions(tables):
+    """Returns {table: version} for `tables`, None when the versions
+    can't be read (e.g. the migration has not run yet)
+    """
+    try:
+        return dict(db.session.query(
+            TableVersion.name, TableVersion.version).filter(
+            TableVersion.name.in_(tables)))
+    except SQLAlchemyError:
+        db.session.rollback()
+        return None
+
+'''
+link_movies_actors(links)
+    inserts the (movie_id, actor_id) pairs in `links` that are not linked
+    yet, in one statement and one transaction, and returns how many were
+    inserted
+'''
+
+
+def link_movies_actors(links):
+    table = MovieActor.__table__
+    links = list(dict.fromkeys(links))
+    try:
+        if db.engine.dialect.name == 'postgresql':
+            statement = postgresql.insert(table).values([
+                {'movie_id': movie_id, 'actor_id': actor_id}
+                for movie_id, actor_id in links
+            ]).on_conflict_do_nothing(
+                index_elements=['movie_id', 'actor_id'])
+            inserted = db.session.execute(statement).rowcount
+        else:
+            movie_ids = {movie_id for movie_id, _ in links}
+            actor_ids = {actor_id for _, actor_id in links}
+            existing = set(db.session.query(
+                MovieActor.movie_id, MovieActor.actor_id).filter(
+                MovieActor.movie_id.in_(movie_ids),
+                MovieActor.actor_id.in_(actor_ids)))
+            rows = [
+                {'movie_id': movie_id, 'actor_id': actor_id}
+                for movie_id, actor_id in links
+                if (movie_id, actor_id) not in existing
+            ]
+            if rows:
+                db.session.execute(table.insert().values(rows))
+            inserted = len(rows)
+        touch(table.name)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    response_cache.bump(table.name)
+    return inserted
@@ -0,0 +1,177 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import g, request, make_response, _request_ctx_stack
+
+
+'''
+ResponseCache
+    LRU cache of rendered GET responses.
+    Every entity (table) has a generation counter that writes bump, and
+    the generations a route depends on are part of its cache key, so a
+    write makes the older entries unreachable instead of having to find
+    and delete them; they age out of the LRU.
+    Generations are per process: `ttl` bounds how long another worker's
+    write can go unseen, 0 disables the bound.
+'''
+class ResponseCache:
+    def __init__(self, maxsize=1024, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._generations = {}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def generation(self, entity):
+        return self._generations.get(entity, 0)
+
+    def bump(self, *entities):
+        """Invalidates every cached response depending on `entities`
+        """
+        with self._lock:
+            for entity in entities:
+                self._generations[entity] = self.generation(entity) + 1
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            stored_at, value = entry
+            if self.ttl and time.monotonic() - stored_at >= self.ttl:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'generations': dict(self._generations),
+            }
+
+    def cached(self, *entities, included=()):
+        """Caches the 200 responses of a GET view that requires_auth wraps.
+        The key is the endpoint, its arguments, the query string, the
+        caller's permissions and the generations of `entities`, plus those
+        of `included` when the request has ?include=.
+        """
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if self.maxsize <= 0:
+                    return f(*args, **kwargs)
+                depends_on = _depends_on(entities, included)
+                # read the generations before querying: a write landing
+                # meanwhile bumps them, so the result is never reused.
+                # Under conditional() the committed table versions are
+                # part of the key too, which also covers other workers.
+                versions = g.get('table_versions')
+                key = _request_key(kwargs) + (
+                    getattr(_request_ctx_stack.top,
+                            'current_permissions', None),
+                    tuple(self.generation(entity) for entity in depends_on),
+                    tuple(sorted(versions.items())) if versions else None,
+                )
+                found = self.get(key)
+                if found is not None:
+                    body, status, mimetype = found
+                    response = make_response(body, status)
+                    response.mimetype = mimetype
+                    response.headers['X-Cache'] = 'HIT'
+                    return response
+
+                response = make_response(f(*args, **kwargs))
+                if response.status_code == 200:
+                    self.put(key, (response.get_data(), response.status_code,
+                                   response.mimetype))
+                response.headers['X-Cache'] = 'MISS'
+                return response
+            return wrapper
+        return decorator
+
+
+def _depends_on(entities, included):
+    if included and 'include' in request.args:
+        return entities + included
+    return entities
+
+
+def _request_key(kwargs):
+    return (
+        request.endpoint,
+        tuple(sorted(kwargs.items())),
+        tuple(sorted(request.args.items(multi=True))),
+    )
+
+
+def conditional(get_versions, *entities, included=()):
+    """Strong ETags for a GET view from the versions of the tables it
+    reads, `get_versions(tables)` returning {table: version} or None.
+    The ETag is known before the view runs, so a matching If-None-Match
+    is answered with a 304 without querying or serializing anything.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            depends_on = _depends_on(entities, included)
+            versions = get_versions(depends_on)
+            if not versions:
+                return f(*args, **kwargs)
+            g.table_versions = versions
+            etag = hashlib.sha1(repr(_request_key(kwargs) + tuple(
+                versions.get(entity) for entity in depends_on
+            )).encode()).hexdigest()
+
+            if request.if_none_match.contains(etag):
+                response = make_response('', 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return decorator
+
+
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 1024))
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 30))
+
+response_cache = ResponseCache(maxsize=RESPONSE_CACHE_SIZE,
+                               ttl=RESPONSE_CACHE_TTL)
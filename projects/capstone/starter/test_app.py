@@ -1,23 +1,48 @@
 
 # Import all dependencies
-import unittest, json, os
+import unittest, json, os, tempfile, asyncio
+import auth
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import Engine
 from app import create_app
-from models import setup_db, Movie, Actor
+from asgi import CatalogApplication
+from models import setup_db, db, Movie, Actor, Gender
+from response_cache import response_cache
+from local_auth import JWKSServer, ROLES, load_keys, mint_token
 
 
 class AppTestCase(unittest.TestCase):
     """This class represents the resource test case"""
 
+    @classmethod
+    def setUpClass(cls):
+        """Serve a local JWKS and mint a token per role, so the suite
+        runs without Auth0 or any network access."""
+        keys = load_keys()
+        cls.jwks_server = JWKSServer(keys).start()
+        auth.jwks_cache.url = cls.jwks_server.url
+        auth.jwks_cache.clear()
+        auth.token_cache.clear()
+        cls.auth_headers = {
+            role: f'Bearer {mint_token(keys, role)}' for role in ROLES
+        }
+
+        # one app for the whole suite, building it is the slow part
+        cls.app = create_app()
+        cls.database_name = "agency"
+        cls.username = 'postgres'
+        cls.password = '123456'
+        cls.url = 'localhost:5432'
+        cls.database_path = "postgres://{}:{}@{}/{}".format(cls.username, cls.password, cls.url, cls.database_name)
+        setup_db(cls.app, cls.database_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.jwks_server.stop()
+
     def setUp(self):
-        """Define test variables and initialize app."""
-        self.app = create_app()
+        """Define test variables."""
         self.client = self.app.test_client
-        self.database_name = "agency"
-        self.username = 'postgres'
-        self.password = '123456'
-        self.url = 'localhost:5432'
-        self.database_path = "postgres://{}:{}@{}/{}".format(self.username, self.password, self.url, self.database_name)
-        setup_db(self.app, self.database_path)
 
         self.new_movie = {
             'title': 'The new Movie',
@@ -25,18 +50,6 @@ class AppTestCase(unittest.TestCase):
         }
 
 
-        # Set up authentication tokens info
-        with open('auth_config.json', 'r') as f:
-            self.auth = json.loads(f.read())
-            assistant_jwt = self.auth["roles"]["Casting Assistant"]["jwt_token"]
-            director_jwt = self.auth["roles"]["Casting Director"]["jwt_token"]
-            producer_jwt = self.auth["roles"]["Executive Producer"]["jwt_token"]
-            self.auth_headers = {
-                "Casting Assistant": f'Bearer {assistant_jwt}',
-                "Casting Director": f'Bearer {director_jwt}',
-                "Executive Producer": f'Bearer {producer_jwt}'
-        }
-
     def tearDown(self):
         """Executed after each test"""
         pass
@@ -51,6 +64,178 @@ class AppTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['movies'])
         
+    def test_get_movies_past_last_page(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Assistant"]
+        }
+        res = self.client().get('/movies', headers=header_obj)
+        total_movies = json.loads(res.data)['total_movies']
+        self.assertEqual(total_movies, Movie.query.count())
+
+        res = self.client().get('/movies?page=' + str(total_movies + 1),
+                                headers=header_obj)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_get_movies_by_cursor(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Assistant"]
+        }
+        seen = []
+        cursor = ''
+        while cursor is not None:
+            res = self.client().get('/movies?cursor=' + cursor,
+                                    headers=header_obj)
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            seen.extend(movie['id'] for movie in data['movies'])
+            cursor = data['next_cursor']
+        expected = [movie.id for movie in Movie.query.order_by(
+            Movie.title.nullslast(), Movie.id).all()]
+        self.assertEqual(seen, expected)
+
+    def test_get_actors_by_cursor_with_null_names(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Assistant"]
+        }
+        # more NULL names than a page holds, so a cursor lands on one
+        unnamed = [Actor(name=None, age=30, gender=Gender.FEMALE)
+                   for _ in range(4)]
+        for actor in unnamed:
+            actor.insert()
+        unnamed = [actor.id for actor in unnamed]
+        try:
+            seen = []
+            cursor = ''
+            while cursor is not None:
+                res = self.client().get('/actors?cursor=' + cursor,
+                                        headers=header_obj)
+                data = json.loads(res.data)
+                self.assertEqual(res.status_code, 200)
+                seen.extend(actor['id'] for actor in data['actors'])
+                cursor = data['next_cursor']
+            expected = [actor.id for actor in Actor.query.order_by(
+                Actor.name.nullslast(), Actor.id).all()]
+            self.assertEqual(seen, expected)
+            self.assertEqual(seen[-4:], unnamed)
+        finally:
+            for actor in Actor.query.filter(Actor.id.in_(unnamed)):
+                actor.delete()
+
+    def test_get_movies_bad_cursor(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Assistant"]
+        }
+        res = self.client().get('/movies?cursor=not-a-cursor',
+                                headers=header_obj)
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_movies_include_actors(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Assistant"]
+        }
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(Engine, 'before_cursor_execute', record)
+        try:
+            res = self.client().get('/movies?cursor=&include=actors',
+                                    headers=header_obj)
+        finally:
+            event.remove(Engine, 'before_cursor_execute', record)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        for movie in data['movies']:
+            self.assertIn('actors', movie)
+        # the table versions for the ETag, the page and one IN query for
+        # the actors of the whole page
+        self.assertEqual(len(statements), 3)
+
+    def test_get_movies_bad_include(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Assistant"]
+        }
+        res = self.client().get('/movies?include=movies', headers=header_obj)
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_movies_not_modified(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Executive Producer"]
+        }
+        res = self.client().get('/movies', headers=header_obj)
+        etag = res.headers['ETag']
+        res = self.client().get('/movies', headers=dict(
+            header_obj, **{'If-None-Match': etag}))
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+        res = self.client().post('/movies/bulk', headers=header_obj, json=[
+            {'title': 'Another Movie', 'release_date': '2015-02-22'}])
+        self.assertEqual(res.status_code, 201)
+        res = self.client().get('/movies', headers=dict(
+            header_obj, **{'If-None-Match': etag}))
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_get_movie_fast_json(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Assistant"]
+        }
+        movie = Movie.query.order_by(Movie.id).first()
+        self.app.config['FAST_JSON'] = True
+        response_cache.clear()
+        try:
+            res = self.client().get('/movies/' + str(movie.id),
+                                    headers=header_obj)
+        finally:
+            self.app.config['FAST_JSON'] = False
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movie']['release_date'],
+                         movie.release_date.isoformat())
+
+    def test_export_movies(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Assistant"]
+        }
+        total_movies = Movie.query.count()
+        res = self.client().get('/movies/export', headers=header_obj)
+        self.assertEqual(res.status_code, 200)
+        lines = res.data.decode().splitlines()
+        self.assertEqual(len(lines), total_movies)
+        self.assertEqual(set(json.loads(lines[0])),
+                         {'id', 'title', 'release_date'})
+
+        res = self.client().get('/movies/export?format=csv',
+                                headers=header_obj)
+        self.assertEqual(res.status_code, 200)
+        lines = res.data.decode().splitlines()
+        self.assertEqual(lines[0], 'id,title,release_date')
+        self.assertEqual(len(lines), total_movies + 1)
+
+        # the header is the first chunk, before any row is fetched
+        res = self.client().get('/movies/export?format=csv',
+                                headers=header_obj, buffered=False)
+        try:
+            self.assertEqual(next(res.iter_encoded()),
+                             b'id,title,release_date\r\n')
+        finally:
+            res.close()
+
+    def test_unauth_export_movies(self):
+        res = self.client().get('/movies/export')
+        self.assertEqual(res.status_code, 401)
+
+    def test_metrics_db_pool(self):
+        res = self.client().get('/metrics')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('pool', data['db_pool'])
+        self.assertIn('wait', data['db_pool'])
+
     def test_add_movie(self):
         header_obj = {
             "Authorization": self.auth_headers["Executive Producer"]
@@ -68,6 +253,41 @@ class AppTestCase(unittest.TestCase):
 
 
 
+    def test_add_movies_bulk(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Executive Producer"]
+        }
+        movies = [
+            {'title': 'Bulk Movie {}'.format(i), 'release_date': '2015-02-22'}
+            for i in range(3)
+        ]
+        res = self.client().post('/movies/bulk', json=movies,
+                                 headers=header_obj)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(len(data['movie_ids']), 3)
+        titles = [Movie.query.get(movie_id).title
+                  for movie_id in data['movie_ids']]
+        self.assertEqual(titles, [movie['title'] for movie in movies])
+
+    def test_faild_add_movies_bulk(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Executive Producer"]
+        }
+        total_movies = Movie.query.count()
+        movies = [
+            {'title': 'Bulk Movie', 'release_date': '2015-02-22'},
+            {'title': '', 'release_date': 'yesterday'},
+        ]
+        res = self.client().post('/movies/bulk', json=movies,
+                                 headers=header_obj)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['errors'][0]['index'], 1)
+        self.assertEqual(set(data['errors'][0]['errors']),
+                         {'title', 'release_date'})
+        self.assertEqual(Movie.query.count(), total_movies)
+
     def test_faild_add_movie(self):
         header_obj = {
             "Authorization": self.auth_headers["Executive Producer"]
@@ -144,6 +364,24 @@ class AppTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
 
+    def test_get_movie_cache_invalidated_by_update(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Director"]
+        }
+        movie = Movie.query.order_by(Movie.id).first()
+        path = '/movies/' + str(movie.id)
+        res = self.client().get(path, headers=header_obj)
+        res = self.client().get(path, headers=header_obj)
+        self.assertEqual(res.headers['X-Cache'], 'HIT')
+
+        res = self.client().patch(path, headers=header_obj,
+                                  json={'title': movie.title + ' (cut)'})
+        self.assertEqual(res.status_code, 200)
+        res = self.client().get(path, headers=header_obj)
+        data = json.loads(res.data)
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertTrue(data['movie']['title'].endswith(' (cut)'))
+
     def test_failed_update_movie(self):
         header_obj = {
             "Authorization": self.auth_headers["Casting Director"]
@@ -167,6 +405,94 @@ class AppTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 401)
         #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++#
 
+    def test_connect_movies_actors_bulk(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Director"]
+        }
+        movie = Movie.query.order_by(Movie.id).first()
+        actors = Actor.query.order_by(Actor.id).limit(2).all()
+        links = [{'movie_id': movie.id, 'actor_id': actor.id}
+                 for actor in actors]
+        res = self.client().post('/movie_actor/bulk', json=links,
+                                 headers=header_obj)
+        self.assertEqual(res.status_code, 201)
+
+        # linking again, with a duplicate in the batch, adds nothing
+        res = self.client().post('/movie_actor/bulk', json=links + links,
+                                 headers=header_obj)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(data['linked'], 0)
+        self.assertEqual(data['skipped'], 4)
+
+    def test_faild_connect_movies_actors_bulk(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Director"]
+        }
+        movie = Movie.query.order_by(Movie.id).first()
+        links = [{'movie_id': movie.id, 'actor_id': 1000000}]
+        res = self.client().post('/movie_actor/bulk', json=links,
+                                 headers=header_obj)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['errors'][0]['errors'],
+                         {'actor_id': 'no such actor'})
+
+    def test_import_catalog(self):
+        total_movies = Movie.query.count()
+        with tempfile.NamedTemporaryFile('w', suffix='.ndjson',
+                                         delete=False) as f:
+            for i in range(5):
+                f.write(json.dumps({'title': 'Imported Movie {}'.format(i),
+                                    'release_date': '2001-01-01'}) + '\n')
+        try:
+            result = self.app.test_cli_runner().invoke(
+                args=['import-catalog', 'movies', f.name, '--chunk-size', '2'])
+        finally:
+            os.remove(f.name)
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('imported 5 rows', result.output)
+        self.assertEqual(Movie.query.count(), total_movies + 5)
+
+    def test_import_catalog_unknown_columns(self):
+        total_movies = Movie.query.count()
+        for content in ('Title,Released\nA,2001-01-01\n',
+                        'title,released\nA,2001-01-01\n'):
+            with tempfile.NamedTemporaryFile('w', suffix='.csv',
+                                             delete=False) as f:
+                f.write(content)
+            try:
+                result = self.app.test_cli_runner().invoke(
+                    args=['import-catalog', 'movies', f.name])
+            finally:
+                os.remove(f.name)
+            self.assertEqual(result.exit_code, 1)
+            self.assertIn('unknown columns', result.output)
+            self.assertIn('expected id, title, release_date', result.output)
+        self.assertEqual(Movie.query.count(), total_movies)
+
+    def test_import_catalog_bad_record(self):
+        total_actors = Actor.query.count()
+        with tempfile.NamedTemporaryFile('w', suffix='.csv',
+                                         delete=False) as f:
+            f.write('name,age,gender\n')
+            f.write('Imported Actor,30,male\n')
+            f.write(',31,female\n')
+            f.write('Imported Actor,32,\n')
+            f.write('Imported Actor,33,unknown\n')
+        try:
+            result = self.app.test_cli_runner().invoke(
+                args=['import-catalog', 'actors', f.name])
+        finally:
+            os.remove(f.name)
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('{}:5:'.format(f.name), result.output)
+        self.assertNotIn('Traceback', result.output)
+        self.assertEqual(Actor.query.count(), total_actors)
+        self.assertIn('ix_actors_name_id',
+                      [index['name'] for index in
+                       inspect(db.engine).get_indexes('actors')])
+
     def test_get_actors(self):
         header_obj = {
             "Authorization": self.auth_headers["Casting Assistant"]
@@ -195,6 +521,22 @@ class AppTestCase(unittest.TestCase):
 
 
 
+    def test_add_actors_bulk(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Director"]
+        }
+        actors = [
+            {'name': 'Bulk Actor {}'.format(i), 'age': 30, 'gender': 'female'}
+            for i in range(3)
+        ]
+        res = self.client().post('/actors/bulk', json=actors,
+                                 headers=header_obj)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 201)
+        names = [Actor.query.get(actor_id).name
+                 for actor_id in data['actor_ids']]
+        self.assertEqual(names, [actor['name'] for actor in actors])
+
     def test_faild_add_actor(self):
         header_obj = {
             "Authorization": self.auth_headers["Casting Director"]
@@ -293,6 +635,85 @@ class AppTestCase(unittest.TestCase):
         })
         self.assertEqual(res.status_code, 401)
 
+    def asgi_request(self, method, path, headers=None, body=b''):
+        """Sends one request through the ASGI app, returns the status,
+        the JSON body (None when empty) and the headers"""
+        application = CatalogApplication(self.database_path)
+        path, _, query = path.partition('?')
+        scope = {
+            'type': 'http', 'method': method, 'path': path,
+            'query_string': query.encode(),
+            'headers': [(name.lower().encode(), value.encode())
+                        for name, value in (headers or {}).items()],
+        }
+        sent = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': body}
+
+        async def send(message):
+            sent.append(message)
+
+        async def run():
+            try:
+                await application(scope, receive, send)
+            finally:
+                await application.shutdown()
+
+        asyncio.run(run())
+        body = sent[1]['body']
+        return (sent[0]['status'], json.loads(body) if body else None,
+                dict(sent[0]['headers']))
+
+    def test_asgi_matches_wsgi(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Assistant"]
+        }
+        for path in ('/movies', '/actors?page=2'):
+            res = self.client().get(path, headers=header_obj)
+            status, data, _ = self.asgi_request('GET', path, header_obj)
+            self.assertEqual(status, res.status_code)
+            self.assertEqual(data, json.loads(res.data))
+
+        status, data, _ = self.asgi_request('GET', '/movies/5000/actors',
+                                         header_obj)
+        self.assertEqual(status, 404)
+
+    def test_asgi_auth(self):
+        status, data, _ = self.asgi_request('GET', '/movies')
+        self.assertEqual(status, 401)
+        self.assertEqual(data['success'], False)
+
+        status, data, _ = self.asgi_request(
+            'POST', '/movie_actor',
+            {"Authorization": self.auth_headers["Casting Assistant"]},
+            json.dumps({'movie_id': 1, 'actor_id': 1}).encode())
+        self.assertEqual(status, 401)
+
+    def test_asgi_cors(self):
+        status, data, headers = self.asgi_request(
+            'OPTIONS', '/movies', {
+                'Origin': 'http://localhost:3000',
+                'Access-Control-Request-Method': 'GET',
+                'Access-Control-Request-Headers': 'authorization'})
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b'access-control-allow-origin'],
+                         b'http://localhost:3000')
+        self.assertIn(b'Authorization',
+                      headers[b'access-control-allow-headers'])
+
+        status, data, headers = self.asgi_request('GET', '/movies')
+        self.assertEqual(status, 401)
+        self.assertEqual(headers[b'access-control-allow-origin'], b'*')
+
+    def test_asgi_rejects_cursor_and_include(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Assistant"]
+        }
+        for path in ('/movies?cursor=', '/actors?include=movies'):
+            status, data, _ = self.asgi_request('GET', path, header_obj)
+            self.assertEqual(status, 400)
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
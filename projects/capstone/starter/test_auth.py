@@ -0,0 +1,389 @@
+# Import all dependencies
+import unittest, json, multiprocessing, os, shutil, tempfile, threading, time
+from functools import lru_cache
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from unittest.mock import patch
+from flask import Flask, jsonify
+
+import auth
+import metrics
+from jwks import JWKSCache
+from local_auth import generate_keys, mint_token
+from token_cache import TokenCache, SharedTokenCache
+
+
+@lru_cache(maxsize=None)
+def signing_keys():
+    """One RSA key pair for the whole module, generating it is slow"""
+    return generate_keys(kid='test-key')
+
+
+class JWKSHandler(BaseHTTPRequestHandler):
+    jwks = {'keys': []}
+    requests = 0
+    fail = False
+
+    def do_GET(self):
+        JWKSHandler.requests += 1
+        if JWKSHandler.fail:
+            self.send_error(503)
+            return
+        body = json.dumps(JWKSHandler.jwks).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class AuthTestCase(unittest.TestCase):
+    """Shared signing keys and local JWKS server for the auth tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.keys = signing_keys()
+        cls.jwks = cls.keys.jwks
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.jwks_path = os.path.join(cls.tmpdir, 'jwks.json')
+        with open(cls.jwks_path, 'w') as f:
+            json.dump(cls.jwks, f)
+
+        JWKSHandler.jwks = cls.jwks
+        cls.server = HTTPServer(('127.0.0.1', 0), JWKSHandler)
+        cls.jwks_url = 'http://127.0.0.1:{}/.well-known/jwks.json'.format(
+            cls.server.server_port)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        shutil.rmtree(cls.tmpdir)
+
+    def setUp(self):
+        JWKSHandler.requests = 0
+        JWKSHandler.fail = False
+        auth.token_cache.clear()
+
+    def make_token(self, permissions=('get:movies',), **claims):
+        return mint_token(self.keys, permissions=permissions,
+                          subject='auth0|test', **claims)
+
+
+class JWKSCacheTestCase(AuthTestCase):
+    """This class represents the signing key cache test case"""
+
+    def test_fetches_once_within_ttl(self):
+        cache = JWKSCache(self.jwks_url, ttl=600)
+        for _ in range(5):
+            self.assertIsNotNone(cache.get_key('test-key'))
+        self.assertEqual(JWKSHandler.requests, 1)
+
+    def test_refetches_after_ttl(self):
+        cache = JWKSCache(self.jwks_url, ttl=0, min_refresh_interval=0)
+        cache.get_key('test-key')
+        cache.get_key('test-key')
+        self.assertEqual(JWKSHandler.requests, 2)
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        cache = JWKSCache(self.jwks_url, ttl=600, min_refresh_interval=60)
+        cache.get_key('test-key')
+        for _ in range(20):
+            self.assertIsNone(cache.get_key('bogus-kid'))
+        self.assertEqual(JWKSHandler.requests, 1)
+
+    def test_unknown_kid_triggers_refetch(self):
+        cache = JWKSCache(self.jwks_url, ttl=600, min_refresh_interval=0)
+        cache.get_key('test-key')
+        self.assertIsNone(cache.get_key('rotated-key'))
+        self.assertEqual(JWKSHandler.requests, 2)
+
+    def test_local_file(self):
+        cache = JWKSCache(self.jwks_path)
+        self.assertIsNotNone(cache.get_key('test-key'))
+        cache = JWKSCache('file://' + self.jwks_path)
+        self.assertIsNotNone(cache.get_key('test-key'))
+
+    def test_serves_stale_keys_when_refresh_fails(self):
+        cache = JWKSCache(self.jwks_url, ttl=0, min_refresh_interval=0,
+                          grace=60)
+        self.assertIsNotNone(cache.get_key('test-key'))
+        JWKSHandler.fail = True
+        self.assertIsNotNone(cache.get_key('test-key'))
+        self.assertEqual(cache.failure_count, 1)
+
+    def test_stale_keys_expire_after_grace(self):
+        cache = JWKSCache(self.jwks_url, ttl=0, min_refresh_interval=0,
+                          grace=0)
+        cache.get_key('test-key')
+        JWKSHandler.fail = True
+        with self.assertRaises(Exception):
+            cache.get_key('test-key')
+
+    def test_background_refresher(self):
+        cache = JWKSCache(self.jwks_url, ttl=1, refresh_ahead=0.1,
+                          min_refresh_interval=0, grace=60)
+        cache.start_refresher()
+        try:
+            deadline = time.monotonic() + 5
+            while cache.fetch_count < 3 and time.monotonic() < deadline:
+                self.assertIsNotNone(cache.get_key('test-key'))
+                time.sleep(0.05)
+            self.assertGreaterEqual(cache.fetch_count, 3)
+
+            # the provider goes down, requests keep the last-known-good
+            # keys and never fetch themselves
+            JWKSHandler.fail = True
+            time.sleep(1.2)
+            started = time.monotonic()
+            self.assertIsNotNone(cache.get_key('test-key'))
+            self.assertLess(time.monotonic() - started, 0.05)
+            self.assertGreater(cache.failure_count, 0)
+        finally:
+            cache.stop_refresher()
+        self.assertFalse(cache.refreshing)
+
+    def test_verify_decode_jwt_uses_cache(self):
+        original = auth.jwks_cache
+        auth.jwks_cache = JWKSCache(self.jwks_url)
+        try:
+            for _ in range(3):
+                payload = auth.verify_decode_jwt(self.make_token())
+                self.assertEqual(payload['permissions'], ['get:movies'])
+        finally:
+            auth.jwks_cache = original
+        self.assertEqual(JWKSHandler.requests, 1)
+
+
+class RequiresAuthTestCase(AuthTestCase):
+    """This class represents the requires_auth decorator test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.original_cache = auth.jwks_cache
+        auth.jwks_cache = JWKSCache(self.jwks_url)
+        self.app = Flask(__name__)
+
+        @self.app.route('/stacked')
+        @auth.requires_auth('get:movies')
+        @auth.requires_auth('get:actors')
+        def stacked(payload):
+            return jsonify({'sub': payload['sub']})
+
+        @self.app.route('/all-of')
+        @auth.requires_auth('get:movies', 'get:actors')
+        def all_of(payload):
+            return jsonify({'sub': payload['sub']})
+
+        @self.app.route('/any-of')
+        @auth.requires_auth('post:movies', 'get:actors', any_of=True)
+        def any_of(payload):
+            return jsonify({'sub': payload['sub']})
+
+        self.app.after_request(auth.record_auth_timings)
+        self.client = self.app.test_client
+
+    def tearDown(self):
+        auth.jwks_cache = self.original_cache
+        metrics.reset('auth')
+
+    def get(self, path, permissions):
+        token = self.make_token(permissions=permissions)
+        return self.client().get(
+            path, headers={'Authorization': f'Bearer {token}'})
+
+    def test_stacked_decorators_decode_once(self):
+        with patch.object(auth, 'verify_token',
+                          wraps=auth.verify_token) as verify:
+            res = self.get('/stacked', ['get:movies', 'get:actors'])
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json()['sub'], 'auth0|test')
+        self.assertEqual(verify.call_count, 1)
+
+    def test_stacked_decorators_check_every_permission(self):
+        res = self.get('/stacked', ['get:movies'])
+        self.assertEqual(res.status_code, 401)
+
+    def test_all_of(self):
+        self.assertEqual(
+            self.get('/all-of', ['get:movies', 'get:actors']).status_code, 200)
+        self.assertEqual(self.get('/all-of', ['get:actors']).status_code, 401)
+
+    def test_permissions_compiled_once(self):
+        scopes = [f'read:scope-{i}' for i in range(500)] + ['get:movies',
+                                                             'get:actors']
+        token = self.make_token(permissions=scopes)
+        for _ in range(2):
+            res = self.client().get(
+                '/all-of', headers={'Authorization': f'Bearer {token}'})
+            self.assertEqual(res.status_code, 200)
+        payload, permissions = auth.token_cache.lookup(token)
+        self.assertIsInstance(permissions, frozenset)
+        self.assertEqual(permissions, frozenset(scopes))
+
+    def test_stage_timings(self):
+        res = self.get('/all-of', ['get:movies', 'get:actors'])
+        stages = [part.split(';')[0]
+                  for part in res.headers['Server-Timing'].split(', ')]
+        self.assertEqual(stages, ['auth-header', 'auth-cache', 'auth-jwks',
+                                  'auth-decode', 'auth-permissions',
+                                  'auth-total'])
+        timings = metrics.snapshot('auth')['all_of']
+        self.assertEqual(timings['decode']['count'], 1)
+        self.assertEqual(timings['total']['count'], 1)
+
+        res = self.get('/all-of', ['get:actors'])
+        self.assertEqual(res.status_code, 401)
+        self.assertIn('auth-permissions', res.headers['Server-Timing'])
+        self.assertEqual(metrics.snapshot('auth')['all_of']['total']['count'], 2)
+
+    def test_any_of(self):
+        self.assertEqual(self.get('/any-of', ['get:actors']).status_code, 200)
+        self.assertEqual(self.get('/any-of', ['get:movies']).status_code, 401)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """This class represents the verified payload cache test case"""
+
+    def test_hit_and_miss_counters(self):
+        cache = TokenCache(maxsize=10)
+        payload = {'sub': 'a', 'exp': time.time() + 60}
+        self.assertIsNone(cache.get('token-a'))
+        cache.put('token-a', payload)
+        self.assertIs(cache.get('token-a'), payload)
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_never_serves_expired_payload(self):
+        cache = TokenCache(maxsize=10)
+        cache.put('token-a', {'sub': 'a', 'exp': time.time() - 1})
+        cache.put('token-b', {'sub': 'b'})
+        self.assertIsNone(cache.get('token-a'))
+        self.assertIsNone(cache.get('token-b'))
+
+        cache._entries[TokenCache.digest('token-c')] = (
+            time.time() - 1, {'sub': 'c'}, None)
+        self.assertIsNone(cache.get('token-c'))
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def test_lru_eviction(self):
+        cache = TokenCache(maxsize=2)
+        exp = time.time() + 60
+        cache.put('token-a', {'sub': 'a', 'exp': exp})
+        cache.put('token-b', {'sub': 'b', 'exp': exp})
+        cache.get('token-a')
+        cache.put('token-c', {'sub': 'c', 'exp': exp})
+        self.assertIsNone(cache.get('token-b'))
+        self.assertIsNotNone(cache.get('token-a'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.stats()['size'], 2)
+
+    def test_expired_entries_make_room_first(self):
+        cache = TokenCache(maxsize=2)
+        exp = time.time() + 60
+        cache.put('token-a', {'sub': 'a', 'exp': exp})
+        cache.put('token-b', {'sub': 'b', 'exp': exp})
+        cache._entries[TokenCache.digest('token-b')] = (
+            time.time() - 1, {'sub': 'b'}, None)
+        cache._next_expiry = time.time() - 1
+        cache.put('token-c', {'sub': 'c', 'exp': exp})
+        self.assertIsNotNone(cache.get('token-a'))
+        self.assertIsNotNone(cache.get('token-c'))
+        stats = cache.stats()
+        self.assertEqual(stats['evictions'], 0)
+        self.assertEqual(stats['expirations'], 1)
+
+
+def fill_shared_cache(path, worker):
+    cache = SharedTokenCache(path)
+    exp = time.time() + 60
+    for i in range(200):
+        cache.put(f'token-{i}', {'sub': f'{worker}-{i}', 'exp': exp})
+    return cache.errors
+
+
+class SharedTokenCacheTestCase(unittest.TestCase):
+    """This class represents the cross-process payload cache test case"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'tokens.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_shared_between_instances(self):
+        worker_a = SharedTokenCache(self.path)
+        worker_b = SharedTokenCache(self.path)
+        payload = {'sub': 'a', 'exp': time.time() + 60,
+                   'permissions': ['get:movies']}
+        worker_a.put('token-a', payload)
+        self.assertEqual(worker_b.get('token-a'), payload)
+        self.assertIsNone(worker_b.get('token-b'))
+
+    def test_never_serves_expired_payload(self):
+        cache = SharedTokenCache(self.path)
+        cache.put('token-a', {'sub': 'a', 'exp': time.time() + 0.2})
+        self.assertIsNotNone(cache.get('token-a'))
+        time.sleep(0.3)
+        self.assertIsNone(cache.get('token-a'))
+
+    def test_prune_keeps_maxsize(self):
+        cache = SharedTokenCache(self.path, maxsize=5)
+        for i in range(10):
+            cache.put(f'token-{i}', {'sub': i, 'exp': time.time() + 60 + i})
+        cache.prune()
+        self.assertEqual(cache.stats()['size'], 5)
+        self.assertIsNotNone(cache.get('token-9'))
+
+    def test_refuses_files_others_can_write(self):
+        open(self.path, 'w').close()
+        os.chmod(self.path, 0o666)
+        with self.assertRaises(PermissionError):
+            SharedTokenCache(self.path)
+
+        os.chmod(self.path, 0o600)
+        open(self.path + '-wal', 'w').close()
+        os.chmod(self.path + '-wal', 0o620)
+        with self.assertRaises(PermissionError):
+            SharedTokenCache(self.path)
+
+    def test_refuses_symlinks_and_shared_directories(self):
+        target = os.path.join(self.tmpdir, 'elsewhere.sqlite')
+        open(target, 'w').close()
+        os.chmod(target, 0o600)
+        os.symlink(target, self.path)
+        with self.assertRaises(PermissionError):
+            SharedTokenCache(self.path)
+
+        shared_dir = os.path.join(self.tmpdir, 'shared')
+        os.mkdir(shared_dir)
+        os.chmod(shared_dir, 0o1777)
+        with self.assertRaises(PermissionError):
+            SharedTokenCache(os.path.join(shared_dir, 'tokens.sqlite'))
+
+    @unittest.skipUnless(hasattr(os, 'geteuid') and os.geteuid() == 0,
+                         'changing the owner needs root')
+    def test_refuses_files_owned_by_others(self):
+        open(self.path, 'w').close()
+        os.chmod(self.path, 0o600)
+        os.chown(self.path, 12345, -1)
+        with self.assertRaises(PermissionError):
+            SharedTokenCache(self.path)
+
+    def test_concurrent_writers(self):
+        with multiprocessing.Pool(4) as pool:
+            errors = pool.starmap(fill_shared_cache,
+                                  [(self.path, worker) for worker in range(4)])
+        self.assertEqual(errors, [0, 0, 0, 0])
+        self.assertEqual(SharedTokenCache(self.path).stats()['size'], 200)
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
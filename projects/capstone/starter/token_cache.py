@@ -0,0 +1,281 @@
+import hashlib
+import json
+import os
+import sqlite3
+import stat
+import threading
+import time
+from collections import OrderedDict
+
+
+def compile_permissions(payload):
+    """The payload's permissions as a frozenset, None when the token
+    carries no permissions claim
+    """
+    permissions = payload.get('permissions')
+    if permissions is None:
+        return None
+    return frozenset(permissions)
+
+
+'''
+TokenCache
+    LRU cache of verified token payloads.
+    Entries are keyed by the SHA-256 digest of the token (the raw token
+    is never kept), hold at most `maxsize` tokens and are dropped at the
+    token's `exp` claim, so a payload is never served past expiry.
+    Expired entries are purged before a live one is evicted to make room.
+    Tokens without an `exp` claim are not cached.
+    Each entry also keeps the token's permissions compiled into a
+    frozenset, so authorization is a set test instead of a list scan.
+'''
+class TokenCache:
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        # earliest `exp` in the cache, nothing to purge before then
+        self._next_expiry = float('inf')
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(token):
+        if isinstance(token, str):
+            token = token.encode()
+        return hashlib.sha256(token).digest()
+
+    def lookup(self, token):
+        """Returns the cached (payload, permissions) for `token`, or None
+        """
+        key = self.digest(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, payload, permissions = entry
+            if time.time() >= expires_at:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return payload, permissions
+
+    def get(self, token):
+        """Returns the cached payload for `token`, or None
+        """
+        entry = self.lookup(token)
+        return entry[0] if entry is not None else None
+
+    def put(self, token, payload, permissions=None):
+        expires_at = payload.get('exp')
+        if not isinstance(expires_at, (int, float)) or self.maxsize <= 0:
+            return
+        if time.time() >= expires_at:
+            return
+        if permissions is None:
+            permissions = compile_permissions(payload)
+        key = self.digest(token)
+        with self._lock:
+            self._entries[key] = (expires_at, payload, permissions)
+            self._entries.move_to_end(key)
+            self._next_expiry = min(self._next_expiry, expires_at)
+            if (len(self._entries) > self.maxsize
+                    and time.time() >= self._next_expiry):
+                self._purge_expired()
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def purge_expired(self):
+        """Drops every expired entry, returns how many were dropped
+        """
+        with self._lock:
+            return self._purge_expired()
+
+    def _purge_expired(self):
+        now = time.time()
+        expired = [key for key, entry in self._entries.items()
+                   if now >= entry[0]]
+        for key in expired:
+            del self._entries[key]
+        self.expirations += len(expired)
+        self._next_expiry = min(
+            (entry[0] for entry in self._entries.values()),
+            default=float('inf'))
+        return len(expired)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._next_expiry = float('inf')
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+def check_private(path, create=False, missing_ok=False, directory=False):
+    """Raises PermissionError unless `path` is owned by the effective
+    user and has no group or other permission bits. Symlinks are refused.
+    """
+    if directory:
+        info = os.lstat(path)
+        kind_ok = stat.S_ISDIR(info.st_mode)
+    else:
+        flags = os.O_RDWR | os.O_NOFOLLOW | (os.O_CREAT if create else 0)
+        try:
+            fd = os.open(path, flags, 0o600)
+        except FileNotFoundError:
+            if missing_ok:
+                return
+            raise
+        except OSError as e:
+            # ELOOP, the path is a symlink
+            raise PermissionError(
+                f'{path}: refusing to follow a symlink') from e
+        try:
+            info = os.fstat(fd)
+        finally:
+            os.close(fd)
+        kind_ok = stat.S_ISREG(info.st_mode)
+    if (not kind_ok or info.st_uid != os.geteuid()
+            or info.st_mode & 0o077):
+        raise PermissionError(
+            f'{path}: must be owned by uid {os.geteuid()} with no group or '
+            f'other permissions (mode {stat.filemode(info.st_mode)}, '
+            f'uid {info.st_uid})')
+
+
+'''
+SharedTokenCache
+    verified payload cache shared by every worker process on the host,
+    backed by a local SQLite file in WAL mode, so a token verified by one
+    worker is reused by the others until it expires.
+    SQLite serializes concurrent writers; a locked or broken cache file
+    is treated as a miss, it never fails the request.
+    Payloads read back are trusted without a signature check, so anyone
+    able to write the file could plant them: the directory, the file and
+    its -wal/-shm companions must belong to this user with no group or
+    other permissions, otherwise the cache refuses to open
+    (PermissionError). Use a private directory, never /tmp itself.
+'''
+class SharedTokenCache:
+    def __init__(self, path, maxsize=100000, timeout=1.0, prune_every=1000):
+        self.path = path
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.prune_every = prune_every
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._puts = 0
+        self._local = threading.local()
+        check_private(os.path.dirname(os.path.abspath(path)), directory=True)
+        check_private(path, create=True)
+        for suffix in ('-wal', '-shm'):
+            check_private(path + suffix, missing_ok=True)
+        connection = self._connect()
+        try:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS tokens ('
+                'digest BLOB PRIMARY KEY, '
+                'expires_at REAL NOT NULL, '
+                'payload TEXT NOT NULL) WITHOUT ROWID')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS ix_tokens_expires_at '
+                'ON tokens (expires_at)')
+        finally:
+            connection.close()
+
+    def _connect(self):
+        connection = sqlite3.connect(
+            self.path, timeout=self.timeout, isolation_level=None)
+        # a cache can lose its last writes on power loss, no need to fsync
+        connection.execute('PRAGMA synchronous=OFF')
+        return connection
+
+    def _connection(self):
+        # one connection per thread, and never one inherited through fork
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.connection = self._connect()
+            local.pid = os.getpid()
+        return local.connection
+
+    def get(self, token):
+        try:
+            row = self._connection().execute(
+                'SELECT payload FROM tokens WHERE digest = ? AND expires_at > ?',
+                (TokenCache.digest(token), time.time())).fetchone()
+        except sqlite3.Error:
+            self.errors += 1
+            row = None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, token, payload):
+        expires_at = payload.get('exp')
+        if not isinstance(expires_at, (int, float)) or time.time() >= expires_at:
+            return
+        try:
+            connection = self._connection()
+            connection.execute(
+                'INSERT OR REPLACE INTO tokens (digest, expires_at, payload) '
+                'VALUES (?, ?, ?)',
+                (TokenCache.digest(token), expires_at, json.dumps(payload)))
+            self._puts += 1
+            if self._puts % self.prune_every == 0:
+                self.prune(connection)
+        except sqlite3.Error:
+            self.errors += 1
+
+    def prune(self, connection=None):
+        """Drops expired tokens, then the soonest-to-expire ones while
+        the cache is over `maxsize`
+        """
+        connection = connection or self._connection()
+        connection.execute('DELETE FROM tokens WHERE expires_at <= ?',
+                           (time.time(),))
+        connection.execute(
+            'DELETE FROM tokens WHERE digest IN ('
+            'SELECT digest FROM tokens ORDER BY expires_at '
+            'LIMIT max((SELECT count(*) FROM tokens) - ?, 0))',
+            (self.maxsize,))
+
+    def clear(self):
+        self._connection().execute('DELETE FROM tokens')
+
+    def stats(self):
+        try:
+            size = self._connection().execute(
+                'SELECT count(*) FROM tokens').fetchone()[0]
+        except sqlite3.Error:
+            size = None
+        lookups = self.hits + self.misses
+        return {
+            'size': size,
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'errors': self.errors,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }